@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+from collections import Counter as Tally
+from contextlib import suppress
+from typing import List, Optional
+
+from database import get_pool
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+dropped_events = Counter("analytics_dropped_events_total", "Events dropped because the queue was full or a write failed")
+
+# Upper bounds in milliseconds; slower requests are counted in the last bucket
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 60000)
+
+
+def _day(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+
+def _bucket(duration_ms: float) -> int:
+    for bound in LATENCY_BUCKETS_MS:
+        if duration_ms <= bound:
+            return bound
+    return LATENCY_BUCKETS_MS[-1]
+
+
+class EventLog:
+    """Append-only usage log written in the background.
+
+    record() only puts the event on an in-memory queue, so handlers never wait
+    on the database. A single task drains the queue every `flush_interval`
+    seconds and writes the batch, together with the daily rollups /stats reads,
+    in one transaction. When more than `max_pending` events are waiting, or a
+    write fails, events are dropped rather than slowing users down.
+    """
+
+    def __init__(self, flush_interval: float = 5.0, max_pending: int = 10000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Events taken off the queue but not yet written
+        self._batch: List[tuple] = []
+
+    def record(self, kind: str, user_id: int, cow_id: Optional[int] = None, duration: Optional[float] = None):
+        """Queue an event; duration is in seconds."""
+        if self._task is None:
+            # Created lazily so the log can be built before the event loop runs
+            self._queue = asyncio.Queue(self.max_pending)
+            self._task = asyncio.create_task(self._run())
+        duration_ms = duration * 1000 if duration is not None else None
+        try:
+            self._queue.put_nowait((time.time(), kind, user_id, cow_id, duration_ms))
+        except asyncio.QueueFull:
+            dropped_events.inc()
+
+    def _drain(self) -> list:
+        batch = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            self._batch.append(await self._queue.get())
+            # Let the batch fill up before writing
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        batch, self._batch = self._batch + self._drain(), []
+        if not batch:
+            return
+        try:
+            await self._write(batch)
+        except asyncio.CancelledError:
+            # Interrupted by close(), which writes it again
+            self._batch = batch + self._batch
+            raise
+        except Exception:
+            dropped_events.inc(len(batch))
+            logger.exception("Failed to write %s analytics events", len(batch))
+
+    async def _write(self, batch: List[tuple]):
+        cows = Tally()
+        users = Tally()
+        latency = Tally()
+        for created_at, kind, user_id, cow_id, duration_ms in batch:
+            day = _day(created_at)
+            users[day, user_id] += 1
+            if kind == "lookup":
+                cows[day, cow_id] += 1
+            if duration_ms is not None:
+                latency[day, kind, _bucket(duration_ms)] += 1
+        async with get_pool().write() as db:
+            await db.executemany(
+                "INSERT INTO events (created_at, kind, user_id, cow_id, duration_ms) VALUES (?, ?, ?, ?, ?)", batch,
+            )
+            await db.executemany("""
+                INSERT INTO daily_cow_lookups (day, cow_id, lookups) VALUES (?, ?, ?)
+                ON CONFLICT(day, cow_id) DO UPDATE SET lookups = lookups + excluded.lookups
+            """, [(day, cow_id, n) for (day, cow_id), n in cows.items()])
+            await db.executemany("""
+                INSERT INTO daily_user_activity (day, user_id, events) VALUES (?, ?, ?)
+                ON CONFLICT(day, user_id) DO UPDATE SET events = events + excluded.events
+            """, [(day, user_id, n) for (day, user_id), n in users.items()])
+            await db.executemany("""
+                INSERT INTO daily_latency (day, kind, bucket_ms, count) VALUES (?, ?, ?, ?)
+                ON CONFLICT(day, kind, bucket_ms) DO UPDATE SET count = count + excluded.count
+            """, [(day, kind, bound, n) for (day, kind, bound), n in latency.items()])
+
+    async def close(self):
+        """Stop the background task and write whatever is still queued."""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+        await self.flush()
+
+
+def percentile(buckets: List[tuple], pct: float) -> Optional[int]:
+    """Upper bound in ms of the bucket holding the pct-th percentile of [(bound, count), ...]."""
+    buckets = sorted(buckets)
+    total = sum(count for _, count in buckets)
+    if not total:
+        return None
+    seen = 0
+    for bound, count in buckets:
+        seen += count
+        if seen >= pct / 100 * total:
+            return bound
+    return buckets[-1][0]
+
+
+async def get_stats(days: int = 7, top: int = 10) -> dict:
+    """Summarize the last `days` days (today included) from the rollup tables."""
+    since = _day(time.time() - (days - 1) * 86400)
+    async with get_pool().read() as db:
+        async with db.execute("""
+            SELECT cow_id, SUM(lookups) AS n FROM daily_cow_lookups
+            WHERE day >= ? GROUP BY cow_id ORDER BY n DESC, cow_id LIMIT ?
+        """, (since, top)) as cursor:
+            top_cows = await cursor.fetchall()
+        async with db.execute(
+            "SELECT COUNT(DISTINCT user_id) FROM daily_user_activity WHERE day >= ?", (since,),
+        ) as cursor:
+            active_users = (await cursor.fetchone())[0]
+        async with db.execute("""
+            SELECT bucket_ms, SUM(count) FROM daily_latency
+            WHERE day >= ? AND kind IN ('lookup', 'lookup_miss') GROUP BY bucket_ms
+        """, (since,)) as cursor:
+            buckets = await cursor.fetchall()
+    return {
+        "days": days,
+        "lookups": sum(count for _, count in buckets),
+        "active_users": active_users,
+        "top_cows": top_cows,
+        "p50": percentile(buckets, 50),
+        "p95": percentile(buckets, 95),
+        "p99": percentile(buckets, 99),
+    }
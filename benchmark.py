@@ -0,0 +1,246 @@
+"""Offline load test: drives bot.dp with synthetic updates, no network involved.
+
+    python benchmark.py --cows 5000 --photos 4 --users 500 --requests 5000 --concurrency 50
+
+Seeds a throwaway SQLite file, replaces the Bot session with one that answers
+every API call locally, and reports latency percentiles, throughput and the
+number of SQL statements and Bot API calls per operation for each scenario.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Must be set before bot/config are imported; the admin is the first synthetic user
+BENCH_ADMIN_ID = 1
+os.environ["ADMIN_IDS"] = str(BENCH_ADMIN_ID)
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("ALBUM_LATENCY", "0.02")
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message, PhotoSize, Update, User
+
+import database
+from locales import get_mst
+
+SCENARIOS = ("lookup", "lookup_miss", "language", "album")
+
+
+class OfflineSession(BaseSession):
+    """Bot session that fakes a successful response for every API method."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+        self._message_ids = itertools.count(1)
+
+    def _message(self, method) -> Message:
+        chat_id = getattr(method, "chat_id", 0)
+        return Message(message_id=next(self._message_ids), date=datetime.now(), chat=Chat(id=chat_id, type="private"))
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        returning = getattr(method, "__returning__", None)
+        if returning is Message:
+            return self._message(method)
+        if getattr(returning, "__origin__", None) is list:
+            return [self._message(method) for _ in getattr(method, "media", ())]
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, statement: str):
+        self.count += 1
+
+
+class Updates:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def message(self, user_id: int, text: str = None, **kwargs) -> Update:
+        return Update(
+            update_id=next(self._ids),
+            message=Message(
+                message_id=next(self._ids),
+                date=datetime.now(),
+                chat=Chat(id=user_id, type="private"),
+                from_user=User(id=user_id, is_bot=False, first_name=f"user{user_id}"),
+                text=text,
+                **kwargs,
+            ),
+        )
+
+    def album(self, user_id: int, size: int) -> list:
+        group_id = f"g{next(self._ids)}"
+        return [
+            self.message(
+                user_id,
+                photo=[PhotoSize(file_id=f"bench-{group_id}-{idx}", file_unique_id=f"u-{group_id}-{idx}", width=1280, height=960)],
+                media_group_id=group_id,
+            )
+            for idx in range(size)
+        ]
+
+
+async def seed(cows: int, photos: int, users: int):
+    async with database.get_pool().write() as db:
+        await db.executemany(
+            "INSERT INTO users (user_id, language, phone_number) VALUES (?, ?, ?)",
+            [(uid, "uz_cyrillic" if uid % 2 else "uz_latin", f"+99890{uid:07d}") for uid in range(1, users + 1)],
+        )
+        await db.executemany(
+            "INSERT INTO cows (cow_id, description) VALUES (?, ?)",
+            [(cow_id, f"Golshtin zoti, yoshi {cow_id % 9 + 1}, sog'ilgan sut {cow_id % 30} litr") for cow_id in range(1, cows + 1)],
+        )
+        await db.executemany(
+            "INSERT INTO photos (id, file_unique_id, file_id) VALUES (?, ?, ?)",
+            [(idx + 1, f"seed-{idx}", f"seed-{idx}") for idx in range(cows * photos)],
+        )
+        await db.executemany(
+            "INSERT INTO cow_photos (cow_id, photo_id, position) VALUES (?, ?, ?)",
+            [(cow_id, (cow_id - 1) * photos + idx + 1, idx) for cow_id in range(1, cows + 1) for idx in range(photos)],
+        )
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def run_scenario(name, dp, bot, args, updates, queries) -> dict:
+    session = bot.session
+    user_ids = list(range(2, args.users + 1)) or [BENCH_ADMIN_ID]
+    latencies = []
+
+    async def one(i: int):
+        user_id = random.choice(user_ids)
+        if name == "lookup":
+            batch = [updates.message(user_id, str(random.randint(1, args.cows)))]
+        elif name == "lookup_miss":
+            batch = [updates.message(user_id, str(args.cows + 1 + i))]
+        elif name == "language":
+            lang_code = random.choice(("uz_latin", "uz_cyrillic"))
+            batch = [updates.message(user_id, get_mst(lang_code, "choose_lang_btn"))]
+        else:
+            # The whole /add conversation, run by the single admin
+            cow_id = args.cows + 1 + i
+            started = time.perf_counter()
+            await dp.feed_update(bot, updates.message(BENCH_ADMIN_ID, "/add"))
+            await dp.feed_update(bot, updates.message(BENCH_ADMIN_ID, str(cow_id)))
+            await asyncio.gather(*(dp.feed_update(bot, u) for u in updates.album(BENCH_ADMIN_ID, args.album_size)))
+            await dp.feed_update(bot, updates.message(BENCH_ADMIN_ID, "/done"))
+            await dp.feed_update(bot, updates.message(BENCH_ADMIN_ID, f"Benchmark cow {cow_id}"))
+            latencies.append(time.perf_counter() - started)
+            return
+        started = time.perf_counter()
+        for update in batch:
+            await dp.feed_update(bot, update)
+        latencies.append(time.perf_counter() - started)
+
+    # The admin flow shares one FSM context, so it cannot run concurrently with itself
+    concurrency = 1 if name == "album" else args.concurrency
+    total = max(1, args.requests // 20) if name == "album" else args.requests
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(i: int):
+        async with semaphore:
+            await one(i)
+
+    queries.count = 0
+    calls_before = session.calls
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "scenario": name,
+        "ops": total,
+        "p50": percentile(latencies, 50) * 1000,
+        "p95": percentile(latencies, 95) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "ops_per_sec": total / elapsed if elapsed else 0.0,
+        "queries_per_op": queries.count / total,
+        "api_calls_per_op": (session.calls - calls_before) / total,
+    }
+
+
+def print_report(results: list):
+    header = f"{'scenario':<12} {'ops':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ops/s':>9} {'sql/op':>7} {'api/op':>7}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['scenario']:<12} {r['ops']:>7} {r['p50']:>8.2f} {r['p95']:>8.2f} {r['p99']:>8.2f}"
+            f" {r['ops_per_sec']:>9.0f} {r['queries_per_op']:>7.2f} {r['api_calls_per_op']:>7.2f}"
+        )
+
+
+async def main(args):
+    import logging
+    logging.disable(logging.INFO)
+    from bot import dp, event_log, scheduler, scheduler_middleware
+    # Measure until the update is processed, not just queued
+    scheduler_middleware.wait = True
+
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="cowbench-")
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=OfflineSession())
+    queries = QueryCounter()
+    try:
+        await database.init_db(os.path.join(workdir, "bench.db"))
+        await seed(args.cows, args.photos, args.users)
+        for conn in database.get_pool().connections():
+            await conn.set_trace_callback(queries)
+        results = []
+        for name in args.scenarios:
+            results.append(await run_scenario(name, dp, bot, args, Updates(), queries))
+        print_report(results)
+    finally:
+        await scheduler.close()
+        await dp.storage.close()
+        await event_log.close()
+        await database.close_db()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cows", type=int, default=2000, help="cows to seed")
+    parser.add_argument("--photos", type=int, default=3, help="photos per seeded cow")
+    parser.add_argument("--users", type=int, default=200, help="registered users to seed")
+    parser.add_argument("--requests", type=int, default=2000, help="operations per scenario")
+    parser.add_argument("--concurrency", type=int, default=20, help="updates in flight at once")
+    parser.add_argument("--album-size", type=int, default=5, help="photos per album in the album scenario")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    return args
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(parse_args()))
+    except KeyboardInterrupt:
+        sys.exit(1)
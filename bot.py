@@ -1,73 +1,143 @@
+import time
+
+# Taken before the heavy imports below, for the startup report
+_import_started = time.perf_counter()
+
 import asyncio
+import hashlib
+import html
+import json
 import logging
 import sys
+from typing import List, Optional
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
-from aiogram.types import Message, PhotoSize, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, BotCommand, InputMediaPhoto
-
-from config import BOT_TOKEN, ADMIN_IDS
-from database import init_db, add_cow, get_cow, get_user_language, set_user_language, delete_cow, set_user_phone, get_user, add_cow_photo, get_cow_photos
+from aiogram.types import CallbackQuery, Message, ReplyKeyboardRemove, BotCommand
+
+from config import (
+    BOT_TOKEN, ADMIN_IDS, ALBUM_LATENCY, ALBUM_AUTO_DONE,
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEB_SERVER_HOST, WEB_SERVER_PORT,
+    FSM_STATE_TTL, METRICS_HOST, METRICS_PORT, UPDATE_WORKERS, UPDATE_QUEUE_LIMIT,
+    SEND_RATE_GLOBAL, SEND_RATE_PER_CHAT, SEND_RATE_PER_GROUP, SEND_MAX_RETRIES, SEND_MAX_RETRY_AFTER,
+    ANALYTICS_FLUSH_INTERVAL, ANALYTICS_QUEUE_LIMIT,
+)
+from database import init_db, close_db, get_meta, set_meta, save_cow, get_cow_photo_page, search_cows, set_user_language, delete_cow, set_user_phone, get_user
+from cards import MEDIA_GROUP_LIMIT, get_cow_card, photo_record, render_media
+from middlewares import (
+    AlbumMiddleware, AlbumReadyMiddleware, HandlerMetricsMiddleware, RequestMetricsMiddleware, SchedulerMiddleware,
+    UpdateMetricsMiddleware, UserProfileMiddleware,
+)
+from scheduler import KeyedScheduler
+from analytics import EventLog, get_stats
+from ratelimit import RateLimitMiddleware
+from metrics import start_metrics_server
 from states import AddCow, DeleteCow
-from locales import get_mst, MESSAGES
+from storage import SQLiteStorage
+from locales import get_mst, LANG_BUTTONS, CHANGE_LANG_BUTTONS
+from keyboards import (
+    CowCallback, CowPhotos, SearchPage, get_lang_keyboard, get_contact_keyboard, get_main_keyboard, get_more_photos_keyboard,
+    get_search_keyboard, search_query,
+)
 from transliterate import latin_to_cyrillic
 
+_imports_done = time.perf_counter()
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
-
-# Initialize Bot and Dispatcher
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+logger = logging.getLogger(__name__)
+
+def create_bot() -> Bot:
+    # Built on demand rather than at import, so tools importing this module don't open a session
+    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    # Registered first so it wraps the metrics middleware: throttling waits are not
+    # counted as API latency and every retry is timed separately
+    bot.session.middleware(RateLimitMiddleware(
+        global_rate=SEND_RATE_GLOBAL, chat_rate=SEND_RATE_PER_CHAT, group_rate=SEND_RATE_PER_GROUP,
+        max_retries=SEND_MAX_RETRIES, max_retry_after=SEND_MAX_RETRY_AFTER,
+    ))
+    bot.session.middleware(RequestMetricsMiddleware())
+    return bot
+
+# FSM state lives in cows.db so half-finished admin flows survive restarts
+dp = Dispatcher(storage=SQLiteStorage(ttl=FSM_STATE_TTL))
+scheduler = KeyedScheduler(workers=UPDATE_WORKERS, max_pending=UPDATE_QUEUE_LIMIT)
+event_log = EventLog(flush_interval=ANALYTICS_FLUSH_INTERVAL, max_pending=ANALYTICS_QUEUE_LIMIT)
+# Order matters: albums are collected as they arrive, then each update is queued
+# behind earlier updates from the same user; everything below runs in a worker
+dp.update.outer_middleware(AlbumMiddleware(latency=ALBUM_LATENCY))
+scheduler_middleware = dp.update.outer_middleware(SchedulerMiddleware(scheduler))
+dp.update.outer_middleware(UpdateMetricsMiddleware())
 router = Router()
+router.message.outer_middleware(UserProfileMiddleware())
+router.message.middleware(HandlerMetricsMiddleware())
+router.message.middleware(AlbumReadyMiddleware())
+router.callback_query.outer_middleware(UserProfileMiddleware())
+router.callback_query.middleware(HandlerMetricsMiddleware())
 dp.include_router(router)
 
-# --- Keyboards ---
-def get_lang_keyboard():
-    kb = [
-        [KeyboardButton(text=MESSAGES["uz_latin"]["choose_lang_btn"])],
-        [KeyboardButton(text=MESSAGES["uz_cyrillic"]["choose_lang_btn"])]
-    ]
-    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True, one_time_keyboard=True)
-
-def get_contact_keyboard(lang_code: str):
-    kb = [
-        [KeyboardButton(text=get_mst(lang_code, "share_contact_btn"), request_contact=True)]
-    ]
-    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True, one_time_keyboard=True)
-
-def get_main_keyboard(lang_code: str):
-    kb = [
-        [KeyboardButton(text=get_mst(lang_code, "change_lang"))]
-    ]
-    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
-
 # --- Helpers ---
-async def get_lang(user_id: int) -> str:
-    lang = await get_user_language(user_id)
+# `profile` is injected into every message handler by UserProfileMiddleware
+def get_lang(profile) -> str:
+    lang = profile['language'] if profile else None
     return lang if lang else "uz_latin" # Default
 
-async def ensure_phone_verified(user_id: int):
+def ensure_phone_verified(profile) -> bool:
     # This is a helper to check if user has phone
-    user = await get_user(user_id)
-    if user and user['phone_number']:
+    if profile and profile['phone_number']:
         return True
     return False
 
-async def set_commands(bot: Bot):
-    commands = [
-        BotCommand(command="start", description="Botni ishga tushirish / Бошлаш"),
-        BotCommand(command="lang", description="Tilni o'zgartirish / Тилни ўзгартириш"),
-        BotCommand(command="add", description="Admin: Qo'shish / Қўшиш"),
-        BotCommand(command="delete", description="Admin: O'chirish / Ўчириш"),
-    ]
-    await bot.set_my_commands(commands)
+BOT_COMMANDS = (
+    BotCommand(command="start", description="Botni ishga tushirish / Бошлаш"),
+    BotCommand(command="lang", description="Tilni o'zgartirish / Тилни ўзгартириш"),
+    BotCommand(command="add", description="Admin: Qo'shish / Қўшиш"),
+    BotCommand(command="delete", description="Admin: O'chirish / Ўчириш"),
+    BotCommand(command="stats", description="Admin: Statistika / Статистика"),
+)
+
+async def set_commands(bot: Bot) -> bool:
+    """Publish BOT_COMMANDS unless this bot already has them; returns whether they were sent."""
+    digest = hashlib.sha256(json.dumps([c.model_dump() for c in BOT_COMMANDS]).encode()).hexdigest()
+    key = f"commands:{bot.id}"
+    if await get_meta(key) == digest:
+        return False
+    await bot.set_my_commands(list(BOT_COMMANDS))
+    await set_meta(key, digest)
+    return True
+
+async def send_cow_card(message: Message, card, lang: str):
+    if card is None:
+        await message.answer(get_mst(lang, "cow_not_found"))
+        return
+    description = card.caption(lang)
+    if len(card.photos) > 1:
+        await message.answer_media_group(card.media_group(lang))
+    elif card.photos:
+        await message.answer_photo(card.photos[0], caption=description)
+    else:
+        await message.answer(description)
+    if card.more_from is not None:
+        # A media group cannot carry buttons, so the next page is offered separately
+        await message.answer(
+            get_mst(lang, "more_photos"), reply_markup=get_more_photos_keyboard(lang, card.cow_id, card.more_from),
+        )
 
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
+def format_latency(bound_ms) -> str:
+    # Percentiles come from rollup buckets, so only an upper bound is known
+    return "—" if bound_ms is None else f"≤{bound_ms}"
+
+def record_lookup(user_id: int, cow_id: int, card, started: float):
+    # Queued only; the event log writes it to the database in the background
+    kind = "lookup" if card is not None else "lookup_miss"
+    event_log.record(kind, user_id, cow_id, time.perf_counter() - started)
+
 
 # --- Handler Order: Critical for aiogram 3.x ---
 # Place /start and language selection handlers BEFORE any generic text handlers.
@@ -77,20 +147,18 @@ def is_admin(user_id: int) -> bool:
 
 # /start handler: works in ANY state
 @router.message(CommandStart(), StateFilter("*"))
-async def cmd_start(message: Message, state: FSMContext):
-    user_id = message.from_user.id
-    user = await get_user(user_id)
+async def cmd_start(message: Message, state: FSMContext, profile):
     # Always allow /start to reset state and show language selection if needed
     await state.clear()
-    if not user or not user['language']:
+    if not profile or not profile['language']:
         await message.answer(
             "Assalomu alaykum! Iltimos, tilni tanlang:\n\nАссалому алайкум! Илтимос, тилни танланг:",
             reply_markup=get_lang_keyboard()
         )
-    elif not user['phone_number']:
-        await message.answer(get_mst(user['language'], "ask_phone"), reply_markup=get_contact_keyboard(user['language']))
+    elif not profile['phone_number']:
+        await message.answer(get_mst(profile['language'], "ask_phone"), reply_markup=get_contact_keyboard(profile['language']))
     else:
-        await message.answer(get_mst(user['language'], "welcome_main"), reply_markup=get_main_keyboard(user['language']))
+        await message.answer(get_mst(profile['language'], "welcome_main"), reply_markup=get_main_keyboard(profile['language']))
 
 # /lang command: works in ANY state
 @router.message(Command("lang"), StateFilter("*"))
@@ -102,15 +170,13 @@ async def cmd_lang(message: Message, state: FSMContext):
     )
 
 # Language selection buttons: works in ANY state
-@router.message(F.text.in_([MESSAGES["uz_latin"]["choose_lang_btn"], MESSAGES["uz_cyrillic"]["choose_lang_btn"]]), StateFilter("*"))
+@router.message(F.text.in_(LANG_BUTTONS), StateFilter("*"))
 async def language_chosen(message: Message, state: FSMContext):
-    text = message.text
     user_id = message.from_user.id
-    lang_code = "uz_latin"
-    if text == MESSAGES["uz_cyrillic"]["choose_lang_btn"]:
-        lang_code = "uz_cyrillic"
+    lang_code = LANG_BUTTONS[message.text]
     await set_user_language(user_id, lang_code)
     await state.clear()
+    # Served from the profile cache, which set_user_language just updated
     user = await get_user(user_id)
     if not user or not user['phone_number']:
         await message.answer(get_mst(lang_code, "lang_selected"), reply_markup=ReplyKeyboardRemove())
@@ -120,7 +186,7 @@ async def language_chosen(message: Message, state: FSMContext):
         await message.answer(get_mst(lang_code, "welcome_main"))
 
 # Change language button: works in ANY state
-@router.message(F.text.in_([MESSAGES["uz_latin"]["change_lang"], MESSAGES["uz_cyrillic"]["change_lang"]]), StateFilter("*"))
+@router.message(F.text.in_(CHANGE_LANG_BUTTONS), StateFilter("*"))
 async def change_lang_btn_click(message: Message, state: FSMContext):
     await cmd_lang(message, state)
 
@@ -132,7 +198,7 @@ async def contact_handler(message: Message, state: FSMContext):
     user_id = message.from_user.id
     phone = message.contact.phone_number
     await set_user_phone(user_id, phone)
-    lang = await get_lang(user_id)
+    lang = get_lang(await get_user(user_id))
     await state.clear()
     await message.answer(get_mst(lang, "welcome_main"), reply_markup=get_main_keyboard(lang))
 
@@ -140,9 +206,9 @@ async def contact_handler(message: Message, state: FSMContext):
 
 # /add command: only for admins, works in ANY state
 @router.message(Command("add"), StateFilter("*"))
-async def cmd_add(message: Message, state: FSMContext):
-    lang = await get_lang(message.from_user.id)
-    if not await ensure_phone_verified(message.from_user.id):
+async def cmd_add(message: Message, state: FSMContext, profile):
+    lang = get_lang(profile)
+    if not ensure_phone_verified(profile):
         await message.answer(get_mst(lang, "ask_phone"), reply_markup=get_contact_keyboard(lang))
         return
     if not is_admin(message.from_user.id):
@@ -153,8 +219,8 @@ async def cmd_add(message: Message, state: FSMContext):
     await state.set_state(AddCow.waiting_for_id)
 
 @router.message(AddCow.waiting_for_id, F.text)
-async def process_cow_id(message: Message, state: FSMContext):
-    lang = await get_lang(message.from_user.id)
+async def process_cow_id(message: Message, state: FSMContext, profile):
+    lang = get_lang(profile)
     if not message.text.isdigit():
         await message.answer(get_mst(lang, "id_must_be_number"))
         return
@@ -164,18 +230,30 @@ async def process_cow_id(message: Message, state: FSMContext):
     await state.set_state(AddCow.waiting_for_photos)
 
 @router.message(AddCow.waiting_for_photos, F.photo)
-async def process_cow_photo(message: Message, state: FSMContext):
-    # Collect photos. Arguments from album are sent as separate messages.
-    photo: PhotoSize = message.photo[-1]
+async def process_cow_photo(message: Message, state: FSMContext, profile, album: Optional[List[Message]] = None):
+    # Collect photos. AlbumMiddleware delivers a whole album as one call.
     data = await state.get_data()
     photos = data.get('photos', [])
-    photos.append(photo.file_id)
-    await state.update_data(photos=photos)
-    # Silent collection. User must send /done.
+    # The same picture sent twice has the same file_unique_id; keep only the first.
+    # Entries saved by older versions are bare file_id strings.
+    seen = {p["file_unique_id"] if isinstance(p, dict) else p for p in photos}
+    for m in album or [message]:
+        if not m.photo:
+            continue
+        photo = photo_record(m.photo)
+        if photo["file_unique_id"] not in seen:
+            seen.add(photo["file_unique_id"])
+            photos.append(photo)
+    data['photos'] = photos
+    await state.set_data(data)
+    if album and ALBUM_AUTO_DONE:
+        await message.answer(get_mst(get_lang(profile), "send_desc"))
+        await state.set_state(AddCow.waiting_for_description)
+    # Otherwise silent collection. User must send /done.
 
 @router.message(AddCow.waiting_for_photos, Command("done"))
-async def process_photos_done(message: Message, state: FSMContext):
-    lang = await get_lang(message.from_user.id)
+async def process_photos_done(message: Message, state: FSMContext, profile):
+    lang = get_lang(profile)
     data = await state.get_data()
     photos = data.get('photos', [])
     if not photos:
@@ -185,28 +263,27 @@ async def process_photos_done(message: Message, state: FSMContext):
     await state.set_state(AddCow.waiting_for_description)
 
 @router.message(AddCow.waiting_for_photos)
-async def process_cow_photo_invalid(message: Message):
-    lang = await get_lang(message.from_user.id)
+async def process_cow_photo_invalid(message: Message, profile):
+    lang = get_lang(profile)
     await message.answer(get_mst(lang, "invalid_photo"))
 
 @router.message(AddCow.waiting_for_description, F.text)
-async def process_cow_description(message: Message, state: FSMContext):
-    lang = await get_lang(message.from_user.id)
+async def process_cow_description(message: Message, state: FSMContext, profile):
+    lang = get_lang(profile)
     description = message.text
     data = await state.get_data()
     cow_id = data['cow_id']
     photos = data['photos']
-    await add_cow(cow_id, description)
-    for p in photos:
-        await add_cow_photo(cow_id, p)
+    # Re-adding an existing cow replaces its photos, all in one transaction
+    await save_cow(cow_id, description, photos)
     await message.answer(get_mst(lang, "cow_saved", cow_id=cow_id), reply_markup=get_main_keyboard(lang))
     await state.clear()
 
 # /delete command: only for admins, works in ANY state
 @router.message(Command("delete"), StateFilter("*"))
-async def cmd_delete(message: Message, state: FSMContext):
-    lang = await get_lang(message.from_user.id)
-    if not await ensure_phone_verified(message.from_user.id):
+async def cmd_delete(message: Message, state: FSMContext, profile):
+    lang = get_lang(profile)
+    if not ensure_phone_verified(profile):
         await message.answer(get_mst(lang, "ask_phone"), reply_markup=get_contact_keyboard(lang))
         return
     if not is_admin(message.from_user.id):
@@ -217,8 +294,8 @@ async def cmd_delete(message: Message, state: FSMContext):
     await state.set_state(DeleteCow.waiting_for_id)
 
 @router.message(DeleteCow.waiting_for_id, F.text)
-async def process_delete_id(message: Message, state: FSMContext):
-    lang = await get_lang(message.from_user.id)
+async def process_delete_id(message: Message, state: FSMContext, profile):
+    lang = get_lang(profile)
     if not message.text.isdigit():
         await message.answer(get_mst(lang, "id_must_be_number"))
         return
@@ -230,54 +307,184 @@ async def process_delete_id(message: Message, state: FSMContext):
         await message.answer(get_mst(lang, "delete_not_found"), reply_markup=get_main_keyboard(lang))
     await state.clear()
 
+# /stats command: only for admins, works in ANY state
+@router.message(Command("stats"), StateFilter("*"))
+async def cmd_stats(message: Message, profile):
+    lang = get_lang(profile)
+    if not ensure_phone_verified(profile):
+        await message.answer(get_mst(lang, "ask_phone"), reply_markup=get_contact_keyboard(lang))
+        return
+    if not is_admin(message.from_user.id):
+        await message.answer(get_mst(lang, "not_authorized"))
+        return
+    # "/stats 30" covers the last 30 days; a week by default
+    parts = message.text.split()
+    days = 7
+    if len(parts) > 1 and parts[1].isdigit():
+        days = max(1, min(int(parts[1]), 366))
+    stats = await get_stats(days)
+    top = "\n".join(f"#{cow_id} — {lookups}" for cow_id, lookups in stats["top_cows"]) or "—"
+    await message.answer(get_mst(
+        lang, "stats", days=days, lookups=stats["lookups"], users=stats["active_users"],
+        p50=format_latency(stats["p50"]), p95=format_latency(stats["p95"]), p99=format_latency(stats["p99"]), top=top,
+    ))
+
 # --- Cow Lookup Handler ---
 # This handler matches ONLY digit messages, and is placed AFTER all command and language handlers.
 # It will NOT capture commands or non-numeric messages.
 @router.message(F.text.regexp(r"^\d+$"), StateFilter("*"))
-async def get_cow_info(message: Message, state: FSMContext):
-    lang = await get_lang(message.from_user.id)
-    if not await ensure_phone_verified(message.from_user.id):
+async def get_cow_info(message: Message, state: FSMContext, profile):
+    lang = get_lang(profile)
+    if not ensure_phone_verified(profile):
         await message.answer(get_mst(lang, "ask_phone"), reply_markup=get_contact_keyboard(lang))
         return
+    started = time.perf_counter()
     cow_id = int(message.text)
-    cow_data = await get_cow(cow_id)
-    if cow_data:
-        # Try to get photos for this cow
-        photos = await get_cow_photos(cow_id)
-        # If cow_data is tuple (description,) or (photo_file_id, description)
-        if isinstance(cow_data, tuple) and len(cow_data) == 2:
-            photo_file_id, description = cow_data
-        else:
-            description = cow_data[0]
-            photo_file_id = None
-        # Automatic Transliteration
-        if lang == "uz_cyrillic":
-            description = latin_to_cyrillic(description)
-        if photos:
-            if len(photos) == 1:
-                await message.answer_photo(photos[0], caption=description)
-            else:
-                media = []
-                for idx, p in enumerate(photos):
-                    caption = description if idx == 0 else None
-                    media.append(InputMediaPhoto(media=p, caption=caption))
-                await message.answer_media_group(media)
-        elif photo_file_id:
-            await message.answer_photo(photo_file_id, caption=description)
-        else:
-            await message.answer(description)
+    card = await get_cow_card(cow_id)
+    await send_cow_card(message, card, lang)
+    record_lookup(message.from_user.id, cow_id, card, started)
+
+# --- Search Handlers ---
+# Any other plain text outside of a flow is treated as a search over descriptions.
+
+SEARCH_PAGE_SIZE = 5
+
+async def render_search_page(lang: str, query: str, page: int):
+    # One extra row tells us whether a next page exists without a COUNT query
+    rows = await search_cows(query, limit=SEARCH_PAGE_SIZE + 1, offset=page * SEARCH_PAGE_SIZE)
+    has_more = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    if not rows:
+        return None, None
+    if lang == "uz_cyrillic":
+        rows = [(cow_id, latin_to_cyrillic(description)) for cow_id, description in rows]
+    lines = [get_mst(lang, "search_results", page=page + 1)]
+    lines.extend(f"#{cow_id} — {html.escape(description[:80])}" for cow_id, description in rows)
+    return "\n".join(lines), get_search_keyboard(rows, query, page, has_more)
+
+@router.message(F.text, ~F.text.startswith("/"), StateFilter(None))
+async def search_cows_by_text(message: Message, profile):
+    lang = get_lang(profile)
+    if not ensure_phone_verified(profile):
+        await message.answer(get_mst(lang, "ask_phone"), reply_markup=get_contact_keyboard(lang))
+        return
+    started = time.perf_counter()
+    text, keyboard = await render_search_page(lang, search_query(message.text), 0)
+    if text is None:
+        await message.answer(get_mst(lang, "search_not_found"))
     else:
-        await message.answer(get_mst(lang, "cow_not_found"))
+        await message.answer(text, reply_markup=keyboard)
+    event_log.record("search", message.from_user.id, duration=time.perf_counter() - started)
+
+@router.callback_query(SearchPage.filter())
+async def search_page(callback: CallbackQuery, callback_data: SearchPage, profile):
+    lang = get_lang(profile)
+    text, keyboard = await render_search_page(lang, callback_data.query, callback_data.page)
+    if text is not None and isinstance(callback.message, Message):
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+@router.callback_query(CowCallback.filter())
+async def open_cow(callback: CallbackQuery, callback_data: CowCallback, profile):
+    lang = get_lang(profile)
+    if isinstance(callback.message, Message):
+        started = time.perf_counter()
+        card = await get_cow_card(callback_data.cow_id)
+        await send_cow_card(callback.message, card, lang)
+        record_lookup(callback.from_user.id, callback_data.cow_id, card, started)
+    await callback.answer()
+
+@router.callback_query(CowPhotos.filter())
+async def more_photos(callback: CallbackQuery, callback_data: CowPhotos, profile):
+    lang = get_lang(profile)
+    cow_id = callback_data.cow_id
+    page = await get_cow_photo_page(cow_id, callback_data.start, limit=MEDIA_GROUP_LIMIT + 1)
+    photos = [file_id for _, file_id in page[:MEDIA_GROUP_LIMIT]]
+    if isinstance(callback.message, Message) and photos:
+        message = callback.message
+        # Drop the button that was used, so the same page is not requested twice
+        await message.edit_reply_markup(reply_markup=None)
+        if len(photos) > 1:
+            await message.answer_media_group(list(render_media(photos)))
+        else:
+            await message.answer_photo(photos[0])
+        if len(page) > MEDIA_GROUP_LIMIT:
+            await message.answer(
+                get_mst(lang, "more_photos"), reply_markup=get_more_photos_keyboard(lang, cow_id, page[-1][0]),
+            )
+    await callback.answer()
 
 # --- Main ---
 
-async def main():
+metrics_runner = None
+
+async def setup_webhook(bot: Bot):
+    if BOT_MODE == "webhook":
+        await bot.set_webhook(
+            f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    else:
+        # getUpdates is refused while a webhook is set
+        await bot.delete_webhook()
+
+async def on_startup(bot: Bot):
+    global metrics_runner
+    started = time.perf_counter()
     await init_db()
-    await set_commands(bot)
-    await dp.start_polling(bot)
+    db_ready = time.perf_counter()
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    # Independent API calls, so they share one round trip of waiting
+    commands_sent, _ = await asyncio.gather(set_commands(bot), setup_webhook(bot))
+    done = time.perf_counter()
+    logger.info(
+        "Started in %.0f ms: imports %.0f ms, database %.0f ms, Telegram setup %.0f ms (commands %s)",
+        (done - _import_started) * 1000, (_imports_done - _import_started) * 1000,
+        (db_ready - started) * 1000, (done - db_ready) * 1000, "published" if commands_sent else "unchanged",
+    )
+
+async def on_shutdown(bot: Bot):
+    # Finish queued updates, then flush pending FSM writes and events while the database is still open
+    await scheduler.close()
+    await dp.storage.close()
+    await event_log.close()
+    await close_db()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+def run_webhook():
+    # Without a secret anyone who finds the URL could post fake updates
+    missing = [name for name, value in (("WEBHOOK_URL", WEBHOOK_URL), ("WEBHOOK_SECRET", WEBHOOK_SECRET)) if not value]
+    if missing:
+        raise SystemExit(f"BOT_MODE=webhook requires {' and '.join(missing)} to be set")
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    bot = create_bot()
+    app = web.Application()
+    # Not in background: the request returns once SchedulerMiddleware has queued the
+    # update, so a full queue slows Telegram down instead of piling up tasks
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, handle_in_background=False,
+    ).register(app, path=WEBHOOK_PATH)
+    # Runs dp startup/shutdown hooks together with the web app
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
+
+async def main():
+    # Concurrency comes from the scheduler; feeding updates one by one lets it apply backpressure
+    await dp.start_polling(create_bot(), handle_as_tasks=False)
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if BOT_MODE == "webhook":
+            run_webhook()
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         print("Bot stopped!")
@@ -0,0 +1,53 @@
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    """Bounded in-process cache with least-recently-used eviction and an optional TTL."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        # Bumped on every invalidation so a reader can tell whether its fill went stale
+        self.generation = 0
+
+    def get(self, key, default=MISSING):
+        item = self._data.get(key, MISSING)
+        if item is MISSING:
+            return default
+        value, expires_at = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+        self.generation += 1
+
+    def clear(self):
+        self._data.clear()
+        self.generation += 1
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Users rarely change language or phone, and every write goes through the cache,
+# so the TTL only bounds how long a profile edited outside the bot can be stale.
+user_profiles = LRUCache(maxsize=10000, ttl=3600)
+
+# Rendered cow cards, keyed by cow_id. database.py drops an entry whenever
+# the cow or its photos change.
+cow_cards = LRUCache(maxsize=2048)
@@ -0,0 +1,89 @@
+from typing import List, NamedTuple, Optional, Tuple
+
+from aiogram.types import InputMediaPhoto, PhotoSize
+
+from cache import MISSING, cow_cards
+from config import PHOTO_MAX_SIDE
+from database import drop_stale_cache, get_cow_with_photos
+from metrics import card_render_seconds, timed
+from transliterate import latin_to_cyrillic
+
+
+# Telegram rejects media groups with more than ten items
+MEDIA_GROUP_LIMIT = 10
+
+
+class CowCard(NamedTuple):
+    """Everything needed to answer a cow lookup, prerendered for both scripts.
+
+    Only the first media group of photos is kept; more_from is the position the
+    next page starts at, or None when the cow has no more photos.
+    """
+    cow_id: int
+    captions: dict
+    photos: Tuple[str, ...]
+    media: dict
+    more_from: Optional[int] = None
+
+    def caption(self, lang_code: str) -> str:
+        return self.captions.get(lang_code, self.captions["uz_latin"])
+
+    def media_group(self, lang_code: str) -> list:
+        return list(self.media.get(lang_code, self.media["uz_latin"]))
+
+
+def render_media(photos, caption: Optional[str] = None) -> tuple:
+    return tuple(
+        InputMediaPhoto(media=p, caption=caption if idx == 0 else None)
+        for idx, p in enumerate(photos)
+    )
+
+
+def photo_record(sizes: List[PhotoSize], max_side: int = PHOTO_MAX_SIDE) -> dict:
+    """Pick the size of a photo worth storing and describe it for save_cow.
+
+    That is the largest size within max_side, or the smallest one if all are bigger.
+    """
+    fitting = [s for s in sizes if max(s.width, s.height) <= max_side]
+    size = max(fitting, key=lambda s: s.width * s.height) if fitting else min(sizes, key=lambda s: s.width * s.height)
+    return {
+        "file_id": size.file_id,
+        "file_unique_id": size.file_unique_id,
+        "width": size.width,
+        "height": size.height,
+        "file_size": size.file_size,
+    }
+
+
+@timed(card_render_seconds)
+def render_card(cow_id: int, description: str, photos, more_from: Optional[int] = None) -> CowCard:
+    captions = {
+        "uz_latin": description,
+        # Automatic Transliteration
+        "uz_cyrillic": latin_to_cyrillic(description),
+    }
+    photos = tuple(photos)
+    if len(photos) > 1:
+        media = {lang_code: render_media(photos, caption) for lang_code, caption in captions.items()}
+    else:
+        media = {lang_code: () for lang_code in captions}
+    return CowCard(cow_id, captions, photos, media, more_from)
+
+
+async def get_cow_card(cow_id: int) -> Optional[CowCard]:
+    await drop_stale_cache()
+    card = cow_cards.get(cow_id)
+    if card is not MISSING:
+        return card
+    generation = cow_cards.generation
+    # One photo past the first page tells us whether there are more, and where they start
+    row = await get_cow_with_photos(cow_id, limit=MEDIA_GROUP_LIMIT + 1)
+    card = None
+    if row:
+        description, photos = row
+        more_from = photos[MEDIA_GROUP_LIMIT][0] if len(photos) > MEDIA_GROUP_LIMIT else None
+        card = render_card(cow_id, description, [file_id for _, file_id in photos[:MEDIA_GROUP_LIMIT]], more_from)
+    # Skip the fill if the cow was changed while we were reading it
+    if cow_cards.generation == generation:
+        cow_cards.set(cow_id, card)
+    return card
@@ -5,3 +5,52 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_IDS = [int(id_str) for id_str in os.getenv("ADMIN_IDS", "").split(",") if id_str.strip()]
+
+# Media group parts are buffered until none arrived for this many seconds
+ALBUM_LATENCY = float(os.getenv("ALBUM_LATENCY", "0.6"))
+# Move on to the description step as soon as an album is received, without /done
+ALBUM_AUTO_DONE = os.getenv("ALBUM_AUTO_DONE", "").lower() in ("1", "true", "yes")
+
+# "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Public HTTPS base URL Telegram should push updates to, e.g. https://bot.example.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Checked against the X-Telegram-Bot-Api-Secret-Token header of every webhook request
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+# Local address the webhook server listens on, usually behind a reverse proxy
+WEB_SERVER_HOST = os.getenv("WEB_SERVER_HOST", "0.0.0.0")
+WEB_SERVER_PORT = int(os.getenv("WEB_SERVER_PORT", "8080"))
+
+# In-progress /add and /delete flows untouched for this many seconds are discarded
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(7 * 24 * 3600)))
+
+# Prometheus-style metrics at http://METRICS_HOST:METRICS_PORT/metrics; 0 disables the endpoint
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Log handlers, queries and API calls slower than this many milliseconds; 0 disables
+SLOW_CALL_MS = float(os.getenv("SLOW_CALL_MS", "0"))
+
+# Updates from different users run concurrently on this many workers; one user's updates stay in order
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))
+# Stop accepting new updates while this many are queued or running
+UPDATE_QUEUE_LIMIT = int(os.getenv("UPDATE_QUEUE_LIMIT", "1000"))
+
+# Outgoing message limits (messages per second); Telegram allows about 30/s overall,
+# 1/s per private chat and 20 per minute per group
+SEND_RATE_GLOBAL = float(os.getenv("SEND_RATE_GLOBAL", "30"))
+SEND_RATE_PER_CHAT = float(os.getenv("SEND_RATE_PER_CHAT", "1"))
+SEND_RATE_PER_GROUP = float(os.getenv("SEND_RATE_PER_GROUP", str(20 / 60)))
+# Retries after a RetryAfter (flood wait) response before giving up
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+# RetryAfter waits longer than this many seconds fail the request instead of being waited out
+SEND_MAX_RETRY_AFTER = float(os.getenv("SEND_MAX_RETRY_AFTER", "30"))
+
+# Store the largest size of an uploaded photo whose longer side fits in this many
+# pixels; Telegram keeps every size, so smaller ones cost less to send back
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", "1280"))
+
+# Usage events are queued in memory and written in one batch every this many seconds
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", "5"))
+# Events beyond this many unwritten ones are dropped instead of slowing requests down
+ANALYTICS_QUEUE_LIMIT = int(os.getenv("ANALYTICS_QUEUE_LIMIT", "10000"))
@@ -1,120 +1,494 @@
+import asyncio
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+
 import aiosqlite
 
+from cache import MISSING, cow_cards, user_profiles
+from metrics import db_query_errors, db_query_seconds, timed, timed_query
+from migrations import migrate
+from transliterate import normalize_for_search
+
 DB_NAME = "cows.db"
 
-async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS cows (
-                cow_id INTEGER PRIMARY KEY,
-                photo_file_id TEXT,
-                description TEXT
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                language TEXT,
-                phone_number TEXT
-            )
-        """)
-        # Simplistic migration for existing databases without phone_number
+# Pragmas applied to every pooled connection. WAL lets readers run while the
+# writer commits; NORMAL sync is safe with WAL and avoids an fsync per read txn.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+class ConnectionPool:
+    """One long-lived writer connection plus a small pool of reader connections."""
+
+    def __init__(self, path: str, readers: int = 3, cached_statements: int = 128):
+        self.path = path
+        self.readers = readers
+        self.cached_statements = cached_statements
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._all_readers = []
+
+    async def _connect(self) -> aiosqlite.Connection:
+        # cached_statements keeps prepared statements alive across calls on the same connection
+        conn = await aiosqlite.connect(self.path, cached_statements=self.cached_statements)
         try:
-            await db.execute("ALTER TABLE users ADD COLUMN phone_number TEXT")
-        except aiosqlite.OperationalError:
-            pass # Column likely exists
-            
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS cow_photos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                cow_id INTEGER,
-                file_id TEXT
-            )
-        """)
-        await db.commit()
+            for pragma in PRAGMAS:
+                await conn.execute(pragma)
+        except BaseException:
+            await conn.close()
+            raise
+        return conn
+
+    async def open(self):
+        # The writer goes first so WAL mode is set before any reader attaches
+        self._writer = await self._connect()
+        # Each connection has its own thread, so the readers can open in parallel
+        results = await asyncio.gather(*(self._connect() for _ in range(self.readers)), return_exceptions=True)
+        # Keep the ones that did open, so close() can release them if another failed
+        self._all_readers = [conn for conn in results if isinstance(conn, aiosqlite.Connection)]
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        for conn in self._all_readers:
+            self._readers.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._all_readers:
+            await conn.close()
+        self._all_readers.clear()
+        self._readers = asyncio.Queue()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    async def data_version(self) -> int:
+        # Read on the writer, whose counter only moves when another connection commits,
+        # i.e. another process such as manage.py
+        async with self._writer.execute("PRAGMA data_version") as cursor:
+            return (await cursor.fetchone())[0]
+
+    def connections(self) -> list:
+        return [self._writer, *self._all_readers] if self._writer is not None else []
+
+    @asynccontextmanager
+    async def read(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        # Serialize writers so transactions from concurrent handlers never interleave
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            await self._writer.commit()
+
+
+_pool = None
+
+
+def get_pool() -> ConnectionPool:
+    if _pool is None:
+        raise RuntimeError("Database is not initialized, call init_db() first")
+    return _pool
+
+
+# RETURNING clauses need 3.35; cow search needs the FTS5 extension
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+
+def check_sqlite():
+    """Fail early with a clear message when the linked SQLite library is too old."""
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(
+            f"SQLite {'.'.join(map(str, MIN_SQLITE_VERSION))} or newer is required, "
+            f"but Python is linked against {sqlite3.sqlite_version}"
+        )
+    db = sqlite3.connect(":memory:")
+    try:
+        db.execute("CREATE VIRTUAL TABLE fts5_probe USING fts5(x)")
+    except sqlite3.OperationalError:
+        raise RuntimeError(f"SQLite {sqlite3.sqlite_version} was built without the FTS5 extension") from None
+    finally:
+        db.close()
+
+
+async def init_db(path: str = DB_NAME):
+    global _pool
+    if _pool is not None:
+        return
+    check_sqlite()
+    pool = ConnectionPool(path)
+    try:
+        await pool.open()
+        async with pool.write() as db:
+            await migrate(db)
+    except BaseException:
+        await pool.close()
+        raise
+    _pool = pool
+
+
+# How often drop_stale_cache() asks SQLite whether another process wrote to the file
+EXTERNAL_WRITE_CHECK_INTERVAL = 1.0
+_data_version = None
+_data_version_checked = 0.0
+
+
+async def drop_stale_cache():
+    """Clear cached cow cards once another process has changed the database.
+
+    Writes made by this process invalidate the cache themselves; this covers
+    imports run with manage.py while the bot is up. Checks at most once per
+    EXTERNAL_WRITE_CHECK_INTERVAL seconds.
+    """
+    global _data_version, _data_version_checked
+    now = time.monotonic()
+    if now - _data_version_checked < EXTERNAL_WRITE_CHECK_INTERVAL:
+        return
+    _data_version_checked = now
+    version = await get_pool().data_version()
+    if _data_version is not None and version != _data_version:
+        cow_cards.clear()
+    _data_version = version
 
+
+async def close_db():
+    global _pool, _data_version
+    if _pool is None:
+        return
+    pool, _pool = _pool, None
+    _data_version = None
+    await pool.close()
+    user_profiles.clear()
+    cow_cards.clear()
+
+
+@timed_query
 async def add_cow(cow_id: int, description: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        # We replace the description. Photos are handled separately.
-        # Check if cow exists to keep photos if we are just updating description? 
-        # But usually add_cow is for new or overwrite. 
-        # Let's assume overwrite logic for description, but we might want to clear old photos if re-adding.
-        # For now, let's keep it simple: Add/Update description.
+    async with get_pool().write() as db:
+        # Add/Update description. Photos are handled separately.
         await db.execute("""
-            INSERT OR REPLACE INTO cows (cow_id, description)
-            VALUES (?, ?)
+            INSERT INTO cows (cow_id, description) VALUES (?, ?)
+            ON CONFLICT(cow_id) DO UPDATE SET description = excluded.description
         """, (cow_id, description))
-        await db.commit()
+        await db.execute(
+            "INSERT OR REPLACE INTO cow_search (rowid, body) VALUES (?, ?)",
+            (cow_id, normalize_for_search(description)),
+        )
+    cow_cards.pop(cow_id)
+
+# A photo is either a dict with file_id, file_unique_id, width, height and
+# file_size, or a bare file_id string (imports, older FSM data), whose file_id
+# then stands in for the unique id.
+def _photo_row(photo):
+    if isinstance(photo, str):
+        return (photo, photo, None, None, None)
+    return (
+        photo.get("file_unique_id") or photo["file_id"], photo["file_id"],
+        photo.get("width"), photo.get("height"), photo.get("file_size"),
+    )
+
+_UPSERT_PHOTO = """
+    INSERT INTO photos (file_unique_id, file_id, width, height, file_size) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(file_unique_id) DO UPDATE SET
+        file_id = excluded.file_id,
+        width = COALESCE(excluded.width, width),
+        height = COALESCE(excluded.height, height),
+        file_size = COALESCE(excluded.file_size, file_size)
+"""
+
+_LINK_PHOTO = """
+    INSERT OR IGNORE INTO cow_photos (cow_id, photo_id, position)
+    VALUES (?, (SELECT id FROM photos WHERE file_unique_id = ?), ?)
+"""
+
+async def _unlink_photos(db: aiosqlite.Connection, cow_id: int) -> list:
+    async with db.execute("DELETE FROM cow_photos WHERE cow_id = ? RETURNING photo_id", (cow_id,)) as cursor:
+        return [row[0] for row in await cursor.fetchall()]
+
+async def _next_position(db: aiosqlite.Connection, cow_id: int) -> int:
+    async with db.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM cow_photos WHERE cow_id = ?", (cow_id,)) as cursor:
+        return (await cursor.fetchone())[0]
+
+async def _prune_photos(db: aiosqlite.Connection, photo_ids):
+    # Drop photos no cow refers to any more; shared ones stay
+    await db.executemany(
+        "DELETE FROM photos WHERE id = ? AND NOT EXISTS (SELECT 1 FROM cow_photos WHERE photo_id = ?)",
+        [(photo_id, photo_id) for photo_id in set(photo_ids)],
+    )
 
-async def add_cow_photo(cow_id: int, file_id: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("INSERT INTO cow_photos (cow_id, file_id) VALUES (?, ?)", (cow_id, file_id))
-        await db.commit()
+@timed_query
+async def add_cow_photo(cow_id: int, photo):
+    row = _photo_row(photo)
+    async with get_pool().write() as db:
+        await db.execute(_UPSERT_PHOTO, row)
+        # New photos go after the cow's existing ones; re-adding the same picture is a no-op
+        await db.execute(_LINK_PHOTO, (cow_id, row[0], await _next_position(db, cow_id)))
+    cow_cards.pop(cow_id)
 
+@timed_query
 async def clear_cow_photos(cow_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("DELETE FROM cow_photos WHERE cow_id = ?", (cow_id,))
-        await db.commit()
+    async with get_pool().write() as db:
+        await _prune_photos(db, await _unlink_photos(db, cow_id))
+    cow_cards.pop(cow_id)
 
+async def save_cow(cow_id: int, description: str, photos, replace_photos: bool = True):
+    """Write a cow and all of its photos in one transaction.
+
+    With replace_photos the cow's old photos are swapped for the new ones atomically,
+    otherwise the new photos are appended after the existing ones.
+    """
+    await save_cows([(cow_id, description, photos)], replace_photos=replace_photos)
+
+@timed_query
+async def save_cows(records, replace_photos: bool = True):
+    """Write many (cow_id, description, photos) records in a single transaction.
+
+    A picture already stored for any cow is reused, not stored again. A cow_id
+    repeated in the batch behaves as if its records were saved one after another:
+    the last description wins, and its photos replace (or are appended to) the
+    earlier ones.
+    """
+    merged = {}
+    for cow_id, description, photos in records:
+        rows = [_photo_row(p) for p in photos]
+        if not replace_photos and cow_id in merged:
+            rows = merged[cow_id][1] + rows
+        merged[cow_id] = (description, rows)
+    records = [(cow_id, description, rows) for cow_id, (description, rows) in merged.items()]
+    async with get_pool().write() as db:
+        await db.executemany("""
+            INSERT INTO cows (cow_id, description) VALUES (?, ?)
+            ON CONFLICT(cow_id) DO UPDATE SET description = excluded.description
+        """, [(cow_id, description) for cow_id, description, _ in records])
+        await db.executemany(
+            "INSERT OR REPLACE INTO cow_search (rowid, body) VALUES (?, ?)",
+            [(cow_id, normalize_for_search(description)) for cow_id, description, _ in records],
+        )
+        starts = {}
+        unlinked = []
+        for cow_id, _, _ in records:
+            if replace_photos:
+                unlinked += await _unlink_photos(db, cow_id)
+            else:
+                starts[cow_id] = await _next_position(db, cow_id)
+        await db.executemany(_UPSERT_PHOTO, [row for _, _, rows in records for row in rows])
+        await db.executemany(_LINK_PHOTO, [
+            (cow_id, row[0], starts.get(cow_id, 0) + idx)
+            for cow_id, _, rows in records
+            for idx, row in enumerate(rows)
+        ])
+        await _prune_photos(db, unlinked)
+    for cow_id, _, _ in records:
+        cow_cards.pop(cow_id)
+
+@timed_query
 async def get_cow(cow_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_pool().read() as db:
         async with db.execute("SELECT description FROM cows WHERE cow_id = ?", (cow_id,)) as cursor:
             desc_row = await cursor.fetchone()
-        async with db.execute("SELECT file_id FROM cow_photos WHERE cow_id = ? LIMIT 1", (cow_id,)) as cursor:
+        if not desc_row:
+            return None
+        async with db.execute("""
+            SELECT p.file_id FROM cow_photos c JOIN photos p ON p.id = c.photo_id
+            WHERE c.cow_id = ? ORDER BY c.position LIMIT 1
+        """, (cow_id,)) as cursor:
             photo_row = await cursor.fetchone()
-        if desc_row:
-            description = desc_row[0]
-            photo_file_id = photo_row[0] if photo_row else None
-            return (photo_file_id, description)
-        return None
+        photo_file_id = photo_row[0] if photo_row else None
+        return (photo_file_id, desc_row[0])
 
+@timed_query
 async def get_cow_photos(cow_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT file_id FROM cow_photos WHERE cow_id = ?", (cow_id,)) as cursor:
+    async with get_pool().read() as db:
+        async with db.execute("""
+            SELECT p.file_id FROM cow_photos c JOIN photos p ON p.id = c.photo_id
+            WHERE c.cow_id = ? ORDER BY c.position
+        """, (cow_id,)) as cursor:
             rows = await cursor.fetchall()
             return [row[0] for row in rows]
 
+@timed_query
+async def get_cow_with_photos(cow_id: int, limit: int = -1):
+    """Return (description, [(position, file_id), ...]) in upload order with one query, or None.
+
+    At most `limit` photos are returned; -1 means all of them.
+    """
+    async with get_pool().read() as db:
+        async with db.execute("""
+            SELECT c.description, cp.position, p.file_id
+            FROM cows c
+            LEFT JOIN cow_photos cp ON cp.cow_id = c.cow_id
+            LEFT JOIN photos p ON p.id = cp.photo_id
+            WHERE c.cow_id = ?
+            ORDER BY cp.position
+            LIMIT ?
+        """, (cow_id, limit)) as cursor:
+            rows = await cursor.fetchall()
+    if not rows:
+        return None
+    return rows[0][0], [(position, file_id) for _, position, file_id in rows if file_id is not None]
+
+@timed_query
+async def get_cow_photo_page(cow_id: int, start: int = 0, limit: int = 10):
+    """Return up to `limit` [(position, file_id), ...] of a cow's photos from position `start` on.
+
+    Seeks through the (cow_id, position) index, so later pages cost the same as the first.
+    """
+    async with get_pool().read() as db:
+        async with db.execute("""
+            SELECT cp.position, p.file_id
+            FROM cow_photos cp JOIN photos p ON p.id = cp.photo_id
+            WHERE cp.cow_id = ? AND cp.position >= ?
+            ORDER BY cp.position
+            LIMIT ?
+        """, (cow_id, start, limit)) as cursor:
+            return await cursor.fetchall()
+
+def _user_row(row):
+    if row is None:
+        return None
+    return {"user_id": row[0], "language": row[1], "phone_number": row[2]}
+
+@timed_query
+async def search_cows(query: str, limit: int = 5, offset: int = 0):
+    """Return [(cow_id, description), ...] whose description matches every word of query.
+
+    Latin and Cyrillic queries are folded the same way as the indexed text, and each
+    word matches as a prefix, so "golsh" finds "Голштин".
+    """
+    words = normalize_for_search(query).split()
+    if not words:
+        return []
+    match = " ".join(f'"{word}"*' for word in words)
+    async with get_pool().read() as db:
+        async with db.execute("""
+            SELECT c.cow_id, c.description
+            FROM cow_search s JOIN cows c ON c.cow_id = s.rowid
+            WHERE cow_search MATCH ?
+            ORDER BY s.rank, c.cow_id
+            LIMIT ? OFFSET ?
+        """, (match, limit, offset)) as cursor:
+            return await cursor.fetchall()
+
+async def iter_cows(batch_size: int = 500):
+    """Yield (cow_id, description, [photo, ...]) for every cow in cow_id order.
+
+    Each photo is a dict with file_id, file_unique_id, width, height and file_size,
+    the same shape save_cows accepts. Rows are fetched in chunks of `batch_size`,
+    so memory use does not grow with the herd.
+    """
+    async with get_pool().read() as db:
+        cursor = await db.execute("""
+            SELECT c.cow_id, c.description, p.file_id, p.file_unique_id, p.width, p.height, p.file_size
+            FROM cows c
+            LEFT JOIN cow_photos cp ON cp.cow_id = c.cow_id
+            LEFT JOIN photos p ON p.id = cp.photo_id
+            ORDER BY c.cow_id, cp.position
+        """)
+        try:
+            current = None
+            while True:
+                rows = await cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for cow_id, description, file_id, file_unique_id, width, height, file_size in rows:
+                    if current is None or current[0] != cow_id:
+                        if current is not None:
+                            yield current
+                        current = (cow_id, description, [])
+                    if file_id is not None:
+                        current[2].append({
+                            "file_id": file_id,
+                            "file_unique_id": file_unique_id,
+                            "width": width,
+                            "height": height,
+                            "file_size": file_size,
+                        })
+            if current is not None:
+                yield current
+        finally:
+            await cursor.close()
+
+@timed_query
 async def set_user_language(user_id: int, language: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Check if user exists to preserve phone if updating only language
-        async with db.execute("SELECT phone_number FROM users WHERE user_id = ?", (user_id,)) as cursor:
+    async with get_pool().write() as db:
+        # Upsert keeps the stored phone number when only the language changes
+        async with db.execute("""
+            INSERT INTO users (user_id, language) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET language = excluded.language
+            RETURNING user_id, language, phone_number
+        """, (user_id, language)) as cursor:
             row = await cursor.fetchone()
-            phone = row[0] if row else None
-            
-        await db.execute("""
-            INSERT OR REPLACE INTO users (user_id, language, phone_number)
-            VALUES (?, ?, ?)
-        """, (user_id, language, phone))
-        await db.commit()
+    user_profiles.set(user_id, _user_row(row))
 
+@timed_query
 async def set_user_phone(user_id: int, phone_number: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Get language to preserve it
-        async with db.execute("SELECT language FROM users WHERE user_id = ?", (user_id,)) as cursor:
+    async with get_pool().write() as db:
+        # Upsert keeps the stored language when only the phone changes
+        async with db.execute("""
+            INSERT INTO users (user_id, phone_number) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET phone_number = excluded.phone_number
+            RETURNING user_id, language, phone_number
+        """, (user_id, phone_number)) as cursor:
             row = await cursor.fetchone()
-            language = row[0] if row else None
-            
-        await db.execute("""
-            INSERT OR REPLACE INTO users (user_id, language, phone_number)
-            VALUES (?, ?, ?)
-        """, (user_id, language, phone_number))
-        await db.commit()
+    user_profiles.set(user_id, _user_row(row))
+
+# Timed under get_user, but only when it has to go to the database; cache hits
+# would otherwise hide real query latency
+@timed(db_query_seconds, db_query_errors, function="get_user")
+async def _load_user(user_id: int):
+    async with get_pool().read() as db:
+        async with db.execute("SELECT user_id, language, phone_number FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            return _user_row(await cursor.fetchone())
 
 async def get_user(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
-            return await cursor.fetchone()
+    # Unknown users are cached as None too; the setters above overwrite that entry
+    user = user_profiles.get(user_id)
+    if user is not MISSING:
+        return user
+    user = await _load_user(user_id)
+    # A setter may have written through while we were reading; keep its newer value
+    if user_profiles.get(user_id) is MISSING:
+        user_profiles.set(user_id, user)
+    return user
 
 async def get_user_language(user_id: int):
     user = await get_user(user_id)
     return user['language'] if user else None
 
+@timed_query
+async def get_meta(key: str):
+    async with get_pool().read() as db:
+        async with db.execute("SELECT value FROM meta WHERE key = ?", (key,)) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row else None
+
+@timed_query
+async def set_meta(key: str, value: str):
+    async with get_pool().write() as db:
+        await db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+@timed_query
 async def delete_cow(cow_id: int) -> bool:
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with get_pool().write() as db:
+        photo_ids = await _unlink_photos(db, cow_id)
         cursor = await db.execute("DELETE FROM cows WHERE cow_id = ?", (cow_id,))
-        await db.commit()
-        # Also clean up photos
-        await db.execute("DELETE FROM cow_photos WHERE cow_id = ?", (cow_id,))
-        await db.commit()
-        return cursor.rowcount > 0
+        await _prune_photos(db, photo_ids)
+        await db.execute("DELETE FROM cow_search WHERE rowid = ?", (cow_id,))
+    cow_cards.pop(cow_id)
+    return cursor.rowcount > 0
@@ -0,0 +1,72 @@
+from functools import lru_cache
+
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+
+from locales import LANGUAGES, get_mst
+from transliterate import normalize_for_search
+
+# Telegram types are frozen pydantic models, so one instance per language
+# can be shared by every reply instead of being rebuilt per message.
+
+
+@lru_cache(maxsize=None)
+def get_lang_keyboard():
+    kb = [[KeyboardButton(text=get_mst(lang_code, "choose_lang_btn"))] for lang_code in LANGUAGES]
+    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True, one_time_keyboard=True)
+
+@lru_cache(maxsize=None)
+def get_contact_keyboard(lang_code: str):
+    kb = [
+        [KeyboardButton(text=get_mst(lang_code, "share_contact_btn"), request_contact=True)]
+    ]
+    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True, one_time_keyboard=True)
+
+@lru_cache(maxsize=None)
+def get_main_keyboard(lang_code: str):
+    kb = [
+        [KeyboardButton(text=get_mst(lang_code, "change_lang"))]
+    ]
+    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
+
+
+class CowCallback(CallbackData, prefix="cow"):
+    cow_id: int
+
+
+class CowPhotos(CallbackData, prefix="photos"):
+    cow_id: int
+    start: int
+
+
+class SearchPage(CallbackData, prefix="search"):
+    page: int
+    query: str
+
+
+# Telegram caps callback data at 64 bytes, and the page number and prefix need some of it
+SEARCH_QUERY_BYTES = 40
+
+
+def search_query(text: str) -> str:
+    """Normalized search text short enough to travel inside SearchPage callback data."""
+    return normalize_for_search(text).encode()[:SEARCH_QUERY_BYTES].decode(errors="ignore").strip()
+
+def get_search_keyboard(rows, query: str, page: int, has_more: bool):
+    kb = [
+        [InlineKeyboardButton(text=f"#{cow_id} {description[:30]}", callback_data=CowCallback(cow_id=cow_id).pack())]
+        for cow_id, description in rows
+    ]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=SearchPage(page=page - 1, query=query).pack()))
+    if has_more:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=SearchPage(page=page + 1, query=query).pack()))
+    if nav:
+        kb.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+def get_more_photos_keyboard(lang_code: str, cow_id: int, start: int):
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=get_mst(lang_code, "more_photos_btn"), callback_data=CowPhotos(cow_id=cow_id, start=start).pack())
+    ]])
@@ -1,3 +1,6 @@
+from string import Formatter
+from types import MappingProxyType
+
 MESSAGES = {
     "uz_latin": {
         "welcome_select_lang": "Assalomu alaykum! Iltimos, tilni tanlang:",
@@ -24,7 +27,12 @@ MESSAGES = {
         "cow_deleted": "Mol #{cow_id} o'chirildi.",
         "delete_not_found": "O'chirish uchun bunday mol topilmadi.",
         "share_contact_btn": "📞 Telefon raqamni yuborish",
-        "ask_phone": "Iltimos, botdan foydalanish uchun telefon raqamingizni yuboring tugmasini bosing:"
+        "ask_phone": "Iltimos, botdan foydalanish uchun telefon raqamingizni yuboring tugmasini bosing:",
+        "search_results": "Qidiruv natijalari ({page}-sahifa):",
+        "search_not_found": "Hech narsa topilmadi. Mol ID raqamini yoki ta'rifidagi so'zni yuboring.",
+        "more_photos": "Molning yana rasmlari bor.",
+        "more_photos_btn": "📷 Yana rasmlar",
+        "stats": "📊 Statistika (oxirgi {days} kun)\nQidiruvlar: {lookups}\nFaol foydalanuvchilar: {users}\nJavob vaqti, ms (p50 / p95 / p99): {p50} / {p95} / {p99}\n\nEng ko'p qidirilgan mollar:\n{top}"
     },
     "uz_cyrillic": {
         "welcome_select_lang": "Ассалому алайкум! Илтимос, тилни танланг:",
@@ -51,13 +59,60 @@ MESSAGES = {
         "cow_deleted": "Мол #{cow_id} ўчирилди.",
         "delete_not_found": "Ўчириш учун бундай мол топилмади.",
         "share_contact_btn": "📞 Телефон рақамни юбориш",
-        "ask_phone": "Илтимос, ботдан фойдаланиш учун телефон рақамингизни юборинг тугмасини босинг:"
+        "ask_phone": "Илтимос, ботдан фойдаланиш учун телефон рақамингизни юборинг тугмасини босинг:",
+        "search_results": "Қидирув натижалари ({page}-саҳифа):",
+        "search_not_found": "Ҳеч нарса топилмади. Мол ID рақамини ёки таърифидаги сўзни юборинг.",
+        "more_photos": "Молнинг яна расмлари бор.",
+        "more_photos_btn": "📷 Яна расмлар",
+        "stats": "📊 Статистика (охирги {days} кун)\nҚидирувлар: {lookups}\nФаол фойдаланувчилар: {users}\nЖавоб вақти, мс (p50 / p95 / p99): {p50} / {p95} / {p99}\n\nЭнг кўп қидирилган моллар:\n{top}"
     }
 }
 
+DEFAULT_LANG = "uz_latin"
+LANGUAGES = tuple(MESSAGES)
+
+
+def _placeholders(text: str) -> frozenset:
+    return frozenset(field for _, field, _, _ in Formatter().parse(text) if field is not None)
+
+
+def _validate(messages: dict):
+    # Every language must define the same keys with the same {placeholders}
+    reference = messages[DEFAULT_LANG]
+    problems = []
+    for lang_code, bundle in messages.items():
+        for key in reference.keys() - bundle.keys():
+            problems.append(f"{lang_code}: missing {key!r}")
+        for key in bundle.keys() - reference.keys():
+            problems.append(f"{lang_code}: unknown {key!r}")
+        for key in reference.keys() & bundle.keys():
+            if _placeholders(reference[key]) != _placeholders(bundle[key]):
+                problems.append(f"{lang_code}: placeholders of {key!r} differ from {DEFAULT_LANG}")
+    if problems:
+        raise ValueError("Invalid locale catalog:\n" + "\n".join(problems))
+
+
+_validate(MESSAGES)
+
+# Read-only per-language bundles; unknown language codes fall back to the default
+_BUNDLES = MappingProxyType({lang_code: MappingProxyType(dict(bundle)) for lang_code, bundle in MESSAGES.items()})
+_DEFAULT_BUNDLE = _BUNDLES[DEFAULT_LANG]
+# Bound str.format of templates that take arguments, so a call skips the attribute lookup
+_FORMATTERS = MappingProxyType({
+    (lang_code, key): text.format
+    for lang_code, bundle in _BUNDLES.items()
+    for key, text in bundle.items()
+    if _placeholders(text)
+})
+
+# Reply keyboard button texts, for filters and reverse lookup
+LANG_BUTTONS = MappingProxyType({bundle["choose_lang_btn"]: lang_code for lang_code, bundle in _BUNDLES.items()})
+CHANGE_LANG_BUTTONS = frozenset(bundle["change_lang"] for bundle in _BUNDLES.values())
+
+
 def get_mst(lang_code: str, key: str, **kwargs) -> str:
-    lang = MESSAGES.get(lang_code, MESSAGES["uz_latin"])
-    text = lang.get(key, key)
     if kwargs:
-        return text.format(**kwargs)
-    return text
+        formatter = _FORMATTERS.get((lang_code, key)) or _FORMATTERS.get((DEFAULT_LANG, key))
+        if formatter is not None:
+            return formatter(**kwargs)
+    return _BUNDLES.get(lang_code, _DEFAULT_BUNDLE).get(key, key)
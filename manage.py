@@ -0,0 +1,218 @@
+"""Bulk cow import/export for cows.db.
+
+    python manage.py import herd.csv               # or herd.jsonl
+    python manage.py import herd.jsonl --resume    # continue after an interrupted run
+    python manage.py export backup.jsonl           # or backup.csv, or - for stdout
+
+Records have a cow_id, a description and a list of photos. In CSV the photos
+column holds several file_ids separated by "|". In JSONL it is a list whose
+entries may also be objects with file_id, file_unique_id, width, height and
+file_size, which is what a JSONL export writes, so the photo dedup keys survive
+a round trip. A photo that names an existing local file is uploaded to
+--upload-chat (the first admin by default) to obtain its Telegram file_id,
+anything else is taken to be a file_id.
+
+Input is read and written in batches, so memory use stays flat for any file
+size. After each committed batch the number of records done is written to
+<input>.progress, which --resume uses to skip them on the next run.
+
+The bot may keep running during an import: it notices writes from this process
+through PRAGMA data_version and drops its cached cow cards within a second.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from itertools import islice
+
+from config import ADMIN_IDS, BOT_TOKEN
+from database import DB_NAME, close_db, init_db, iter_cows, save_cows
+
+logger = logging.getLogger("manage")
+
+PHOTO_SEPARATOR = "|"
+
+
+def _format(path: str, explicit: str = None) -> str:
+    if explicit:
+        return explicit
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+def read_records(stream, fmt: str):
+    """Yield (cow_id, description, [photo, ...]) from a CSV or JSONL stream."""
+    if fmt == "csv":
+        for row in csv.DictReader(stream):
+            photos = [p.strip() for p in (row.get("photos") or "").split(PHOTO_SEPARATOR) if p.strip()]
+            yield int(row["cow_id"]), row.get("description") or "", photos
+    else:
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            yield int(record["cow_id"]), record.get("description") or "", list(record.get("photos") or [])
+
+
+class PhotoUploader:
+    """Uploads local images with at most `concurrency` requests in flight and returns their photo records."""
+
+    def __init__(self, chat_id: int, concurrency: int = 4, delete_after: bool = True):
+        from aiogram import Bot
+        from ratelimit import RateLimitMiddleware
+
+        self.chat_id = chat_id
+        self.delete_after = delete_after
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.bot = Bot(token=BOT_TOKEN)
+        self.bot.session.middleware(RateLimitMiddleware())
+        self.uploaded = 0
+
+    async def upload(self, path: str) -> dict:
+        from aiogram.types import FSInputFile
+
+        from cards import photo_record
+
+        async with self._semaphore:
+            message = await self.bot.send_photo(self.chat_id, FSInputFile(path))
+            if self.delete_after:
+                await self.bot.delete_message(self.chat_id, message.message_id)
+        self.uploaded += 1
+        return photo_record(message.photo)
+
+    async def close(self):
+        await self.bot.session.close()
+
+
+async def resolve_photos(batch, uploader, disabled_reason=None):
+    """Replace local paths in a batch with uploaded photos, uploading them concurrently.
+
+    disabled_reason says why uploader is None, for the error on a local path.
+    """
+    paths = {p for _, _, photos in batch for p in photos if isinstance(p, str) and os.path.isfile(p)}
+    if not paths:
+        return batch
+    if uploader is None:
+        raise SystemExit(f"Local photo {next(iter(paths))} found but uploading is disabled: {disabled_reason}")
+    paths = sorted(paths)
+    uploaded = dict(zip(paths, await asyncio.gather(*(uploader.upload(p) for p in paths))))
+    return [
+        (cow_id, description, [uploaded.get(p, p) if isinstance(p, str) else p for p in photos])
+        for cow_id, description, photos in batch
+    ]
+
+
+async def import_cows(args):
+    progress_path = args.input + ".progress"
+    skip = 0
+    if args.resume and os.path.exists(progress_path):
+        with open(progress_path) as f:
+            skip = int(f.read().strip() or 0)
+        logger.info("Resuming after %s records", skip)
+
+    uploader = None
+    chat_id = args.upload_chat or (ADMIN_IDS[0] if ADMIN_IDS else None)
+    if args.no_upload:
+        disabled_reason = "--no-upload was given"
+    elif not BOT_TOKEN:
+        disabled_reason = "BOT_TOKEN is not set"
+    elif chat_id is None:
+        disabled_reason = "no upload chat; set ADMIN_IDS or pass --upload-chat"
+    else:
+        disabled_reason = None
+        uploader = PhotoUploader(chat_id, concurrency=args.upload_concurrency)
+
+    done = skip
+    started = time.perf_counter()
+    try:
+        with open(args.input, newline="", encoding="utf-8") as stream:
+            records = islice(read_records(stream, _format(args.input, args.format)), skip, None)
+            while True:
+                batch = list(islice(records, args.batch_size))
+                if not batch:
+                    break
+                batch = await resolve_photos(batch, uploader, disabled_reason)
+                await save_cows(batch, replace_photos=not args.append_photos)
+                done += len(batch)
+                with open(progress_path, "w") as f:
+                    f.write(str(done))
+                rate = (done - skip) / (time.perf_counter() - started)
+                logger.info("Imported %s records (%.0f/s)", done, rate)
+    finally:
+        if uploader is not None:
+            await uploader.close()
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    logger.info(
+        "Done: %s records, %s photos uploaded",
+        done - skip, uploader.uploaded if uploader else 0,
+    )
+
+
+async def export_cows(args):
+    fmt = _format(args.output, args.format)
+    stream = sys.stdout if args.output == "-" else open(args.output, "w", newline="", encoding="utf-8")
+    count = 0
+    cows = iter_cows(batch_size=args.batch_size)
+    try:
+        writer = None
+        if fmt == "csv":
+            writer = csv.writer(stream)
+            writer.writerow(["cow_id", "description", "photos"])
+        async for cow_id, description, photos in cows:
+            if writer is not None:
+                # CSV has room for file_ids only; JSONL keeps the full photo objects
+                writer.writerow([cow_id, description, PHOTO_SEPARATOR.join(p["file_id"] for p in photos)])
+            else:
+                stream.write(json.dumps(
+                    {"cow_id": cow_id, "description": description, "photos": photos}, ensure_ascii=False,
+                ) + "\n")
+            count += 1
+            if count % args.batch_size == 0:
+                logger.info("Exported %s records", count)
+    finally:
+        # Release the reader connection before the pool is closed, even on early exit
+        await cows.aclose()
+        if stream is not sys.stdout:
+            stream.close()
+    logger.info("Done: %s records", count)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk cow import/export for cows.db")
+    parser.add_argument("--db", default=DB_NAME, help="database file (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="records per transaction")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="file format (default: from extension)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import", help="load cows from a CSV or JSONL file")
+    import_parser.add_argument("input")
+    import_parser.add_argument("--resume", action="store_true", help="skip records committed by an earlier run")
+    import_parser.add_argument("--append-photos", action="store_true", help="keep existing photos instead of replacing them")
+    import_parser.add_argument("--no-upload", action="store_true", help="fail instead of uploading local images")
+    import_parser.add_argument("--upload-chat", type=int, help="chat used to upload local images (default: first admin)")
+    import_parser.add_argument("--upload-concurrency", type=int, default=4, help="uploads in flight at once")
+
+    export_parser = commands.add_parser("export", help="write every cow to a CSV or JSONL file")
+    export_parser.add_argument("output", help='output file, or "-" for stdout')
+    return parser.parse_args(argv)
+
+
+async def main(args):
+    await init_db(args.db)
+    try:
+        if args.command == "import":
+            await import_cows(args)
+        else:
+            await export_cows(args)
+    finally:
+        await close_db()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,180 @@
+import functools
+import inspect
+import logging
+import time
+from typing import Dict, List, Tuple
+
+from config import SLOW_CALL_MS
+
+logger = logging.getLogger(__name__)
+
+# Seconds; tuned for calls between half a millisecond and a few seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY: List["Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, object] = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, self._labels(key), value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, self._labels(key), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [per-bucket counts, sum, count]
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][idx] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", self._labels(key, f'le="{bound}"'), cumulative
+            yield f"{self.name}_bucket", self._labels(key, 'le="+Inf"'), count
+            yield f"{self.name}_sum", self._labels(key), total
+            yield f"{self.name}_count", self._labels(key), count
+
+
+handler_seconds = Histogram("bot_handler_seconds", "Time spent in message handlers", ("handler",))
+handler_errors = Counter("bot_handler_errors_total", "Handlers that raised", ("handler",))
+update_seconds = Histogram("bot_update_seconds", "Time to process an update end to end", ("type",))
+db_query_seconds = Histogram("db_query_seconds", "Time spent in database.py functions", ("function",))
+db_query_errors = Counter("db_query_errors_total", "database.py calls that raised", ("function",))
+api_request_seconds = Histogram("telegram_api_seconds", "Bot API request latency", ("method",))
+api_request_errors = Counter("telegram_api_errors_total", "Failed Bot API requests", ("method", "error"))
+card_render_seconds = Histogram("card_render_seconds", "Time to render a cow card, mostly transliteration")
+
+
+def observe(histogram: Histogram, seconds: float, **labels):
+    histogram.observe(seconds, **labels)
+    if SLOW_CALL_MS and seconds * 1000 >= SLOW_CALL_MS:
+        detail = ", ".join(f"{k}={v}" for k, v in labels.items())
+        logger.warning("Slow call: %s %s took %.1f ms", histogram.name, detail, seconds * 1000)
+
+
+def timed(histogram: Histogram, errors: Counter = None, **labels):
+    """Decorator recording the duration of a sync or async function in `histogram`."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(**labels)
+                    raise
+                finally:
+                    observe(histogram, time.perf_counter() - started, **labels)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(**labels)
+                    raise
+                finally:
+                    observe(histogram, time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
+def timed_query(func):
+    """Times a database.py function under its own name."""
+    return timed(db_query_seconds, db_query_errors, function=func.__name__)(func)
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+async def start_metrics_server(host: str, port: int):
+    """Serve render() at http://host:port/metrics. Returns the runner to clean up on shutdown."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics available at http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,212 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import Message, TelegramObject
+
+from database import get_user
+from scheduler import KeyedScheduler
+from metrics import (
+    api_request_errors, api_request_seconds, handler_errors, handler_seconds, observe, update_seconds,
+)
+
+
+class UserProfileMiddleware(BaseMiddleware):
+    """Loads the sender's profile once per update and passes it to handlers as `profile`."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        data["profile"] = await get_user(user.id) if user else None
+        return await handler(event, data)
+
+
+class AlbumMiddleware(BaseMiddleware):
+    """Collects the parts of a media group as they arrive so handlers see an album once.
+
+    Telegram delivers an album as separate messages sharing a media_group_id.
+    Registered as an outer dispatcher middleware in front of SchedulerMiddleware:
+    the first part is passed on right away, keeping its place in the sender's
+    queue, with `album` set to a future that resolves to all parts (ordered by
+    message_id) once no new part has arrived for `latency` seconds. The other
+    parts are swallowed. AlbumReadyMiddleware awaits the future just before the
+    handler runs.
+    """
+
+    def __init__(self, latency: float = 0.6):
+        self.latency = latency
+        self._albums: Dict[Tuple[int, str], List[Message]] = {}
+        self._collectors = set()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        message = getattr(event, "message", None)
+        if message is None or not message.media_group_id:
+            return await handler(event, data)
+        key = (message.chat.id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is not None:
+            album.append(message)
+            return None
+        self._albums[key] = album = [message]
+        ready = asyncio.get_running_loop().create_future()
+        collector = asyncio.create_task(self._collect(key, album, ready))
+        self._collectors.add(collector)
+        collector.add_done_callback(self._collectors.discard)
+        data["album"] = ready
+        return await handler(event, data)
+
+    async def _collect(self, key: Tuple[int, str], album: List[Message], ready: asyncio.Future):
+        try:
+            # Debounce: keep waiting while parts are still arriving
+            seen = 0
+            while seen != len(album):
+                seen = len(album)
+                await asyncio.sleep(self.latency)
+        finally:
+            del self._albums[key]
+            if not ready.done():
+                album.sort(key=lambda message: message.message_id)
+                ready.set_result(album)
+
+
+class AlbumReadyMiddleware(BaseMiddleware):
+    """Inner router middleware that swaps the pending `album` future for the finished album."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        album = data.get("album")
+        if isinstance(album, asyncio.Future):
+            data["album"] = await album
+        return await handler(event, data)
+
+
+class SchedulerMiddleware(BaseMiddleware):
+    """Outer dispatcher middleware handing each update to a KeyedScheduler.
+
+    Updates from different users are processed concurrently, updates from the
+    same user strictly in order, so an admin's /add steps never overtake each
+    other. By default the update is acknowledged as soon as it is queued; with
+    `wait=True` the call returns only after the update was processed. The first
+    part of an album is queued even when the scheduler is full, so intake keeps
+    going while the rest of the album arrives.
+    """
+
+    def __init__(self, scheduler: KeyedScheduler, wait: bool = False):
+        self.scheduler = scheduler
+        self.wait = wait
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        if user is not None:
+            key = ("user", user.id)
+        elif chat is not None:
+            key = ("chat", chat.id)
+        else:
+            key = ("update", id(event))
+        done = asyncio.get_running_loop().create_future() if self.wait else None
+
+        async def job():
+            # FSMContextMiddleware read the state when the update arrived; earlier
+            # updates from this user may have changed it while this one was queued
+            state = data.get("state")
+            if state is not None:
+                data["raw_state"] = await state.get_state()
+            try:
+                result = await handler(event, data)
+            except BaseException as e:
+                if done is not None and not done.done():
+                    done.set_exception(e)
+                    return
+                raise
+            if done is not None and not done.done():
+                done.set_result(result)
+
+        if data.get("album") is not None:
+            # Waiting for a slot here would stall intake before the album's other
+            # parts are fetched, and the collector would resolve a partial album
+            self.scheduler.submit_nowait(key, job)
+        else:
+            await self.scheduler.submit(key, job)
+        if done is not None:
+            return await done
+        return None
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer dispatcher middleware timing every update from arrival to the last handler."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            observe(update_seconds, time.perf_counter() - started, type=getattr(event, "event_type", "unknown"))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner router middleware timing each handler under its function name."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            observe(handler_seconds, time.perf_counter() - started, handler=name)
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    """Bot session middleware timing outgoing Bot API requests per method."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            api_request_errors.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            observe(api_request_seconds, time.perf_counter() - started, method=name)
@@ -0,0 +1,227 @@
+import aiosqlite
+
+from transliterate import normalize_for_search
+
+# Each migration upgrades the schema by one version. The current version is
+# stored in PRAGMA user_version, so only migrations newer than it are run.
+# Never edit a migration that has shipped; append a new one instead.
+
+
+async def _columns(db: aiosqlite.Connection, table: str) -> set:
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return {row[1] for row in await cursor.fetchall()}
+
+
+async def _initial_schema(db: aiosqlite.Connection):
+    # Matches the layout databases had before versioning, so old files pass through untouched
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS cows (
+            cow_id INTEGER PRIMARY KEY,
+            photo_file_id TEXT,
+            description TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            language TEXT,
+            phone_number TEXT
+        )
+    """)
+    if "phone_number" not in await _columns(db, "users"):
+        await db.execute("ALTER TABLE users ADD COLUMN phone_number TEXT")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS cow_photos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cow_id INTEGER,
+            file_id TEXT
+        )
+    """)
+
+
+async def _normalize_cow_photos(db: aiosqlite.Connection):
+    # Move the legacy single-photo column into cow_photos before dropping it
+    await db.execute("""
+        INSERT INTO cow_photos (cow_id, file_id)
+        SELECT cow_id, photo_file_id FROM cows
+        WHERE photo_file_id IS NOT NULL
+          AND cow_id NOT IN (SELECT cow_id FROM cow_photos WHERE cow_id IS NOT NULL)
+    """)
+    await db.execute("""
+        CREATE TABLE cows_new (
+            cow_id INTEGER PRIMARY KEY,
+            description TEXT
+        )
+    """)
+    await db.execute("INSERT INTO cows_new (cow_id, description) SELECT cow_id, description FROM cows")
+    await db.execute("DROP TABLE cows")
+    await db.execute("ALTER TABLE cows_new RENAME TO cows")
+
+    await db.execute("""
+        CREATE TABLE cow_photos_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            cow_id INTEGER NOT NULL REFERENCES cows (cow_id) ON DELETE CASCADE,
+            file_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            UNIQUE (cow_id, file_id)
+        )
+    """)
+    # Orphaned photos and repeated file_ids are dropped; upload order becomes position
+    await db.execute("""
+        INSERT OR IGNORE INTO cow_photos_new (cow_id, file_id, position)
+        SELECT cow_id, file_id, ROW_NUMBER() OVER (PARTITION BY cow_id ORDER BY id) - 1
+        FROM cow_photos
+        WHERE file_id IS NOT NULL AND cow_id IN (SELECT cow_id FROM cows)
+        ORDER BY id
+    """)
+    await db.execute("DROP TABLE cow_photos")
+    await db.execute("ALTER TABLE cow_photos_new RENAME TO cow_photos")
+    await db.execute("CREATE INDEX idx_cow_photos_cow ON cow_photos (cow_id, position, id)")
+
+
+async def _fsm_states(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX idx_fsm_states_updated ON fsm_states (updated_at)")
+
+
+async def _cow_search(db: aiosqlite.Connection):
+    # rowid is the cow_id; body is the description folded by normalize_for_search
+    await db.execute("CREATE VIRTUAL TABLE cow_search USING fts5 (body, tokenize = 'unicode61 remove_diacritics 2')")
+    async with db.execute("SELECT cow_id, description FROM cows") as cursor:
+        rows = await cursor.fetchall()
+    await db.executemany(
+        "INSERT INTO cow_search (rowid, body) VALUES (?, ?)",
+        [(cow_id, normalize_for_search(description or "")) for cow_id, description in rows],
+    )
+
+
+async def _shared_photos(db: aiosqlite.Connection):
+    # One row per distinct picture, keyed by Telegram's file_unique_id, which stays
+    # the same however often the picture is sent. Legacy rows only have a file_id,
+    # so it stands in for the unique id.
+    await db.execute("""
+        CREATE TABLE photos (
+            id INTEGER PRIMARY KEY,
+            file_unique_id TEXT NOT NULL UNIQUE,
+            file_id TEXT NOT NULL,
+            width INTEGER,
+            height INTEGER,
+            file_size INTEGER
+        )
+    """)
+    await db.execute("""
+        INSERT OR IGNORE INTO photos (file_unique_id, file_id)
+        SELECT file_id, file_id FROM cow_photos ORDER BY id
+    """)
+    await db.execute("""
+        CREATE TABLE cow_photos_new (
+            cow_id INTEGER NOT NULL REFERENCES cows (cow_id) ON DELETE CASCADE,
+            photo_id INTEGER NOT NULL REFERENCES photos (id),
+            position INTEGER NOT NULL,
+            PRIMARY KEY (cow_id, photo_id)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        INSERT INTO cow_photos_new (cow_id, photo_id, position)
+        SELECT c.cow_id, p.id, c.position
+        FROM cow_photos c JOIN photos p ON p.file_unique_id = c.file_id
+    """)
+    await db.execute("DROP TABLE cow_photos")
+    await db.execute("ALTER TABLE cow_photos_new RENAME TO cow_photos")
+    await db.execute("CREATE INDEX idx_cow_photos_cow ON cow_photos (cow_id, position)")
+    # Lets pruning check whether any other cow still uses a photo
+    await db.execute("CREATE INDEX idx_cow_photos_photo ON cow_photos (photo_id)")
+
+
+async def _analytics(db: aiosqlite.Connection):
+    # Raw events are append-only; /stats reads the daily rollups kept next to them
+    await db.execute("""
+        CREATE TABLE events (
+            id INTEGER PRIMARY KEY,
+            created_at REAL NOT NULL,
+            kind TEXT NOT NULL,
+            user_id INTEGER,
+            cow_id INTEGER,
+            duration_ms REAL
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE daily_cow_lookups (
+            day TEXT NOT NULL,
+            cow_id INTEGER NOT NULL,
+            lookups INTEGER NOT NULL,
+            PRIMARY KEY (day, cow_id)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        CREATE TABLE daily_user_activity (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            events INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        CREATE TABLE daily_latency (
+            day TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            bucket_ms INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (day, kind, bucket_ms)
+        ) WITHOUT ROWID
+    """)
+
+
+async def _meta(db: aiosqlite.Connection):
+    # Small key/value facts the bot remembers between runs, such as the published command hash
+    await db.execute("""
+        CREATE TABLE meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+MIGRATIONS = [
+    _initial_schema,
+    _normalize_cow_photos,
+    _fsm_states,
+    _cow_search,
+    _shared_photos,
+    _analytics,
+    _meta,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    async with db.execute("PRAGMA user_version") as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def migrate(db: aiosqlite.Connection) -> int:
+    """Bring the database up to SCHEMA_VERSION, one transaction per migration.
+
+    Returns the version the database was at before migrating.
+    """
+    version = await get_schema_version(db)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Database schema v{version} is newer than this bot (v{SCHEMA_VERSION})")
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        await db.execute("BEGIN")
+        try:
+            await migration(db)
+            await db.execute(f"PRAGMA user_version = {number}")
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+    return version
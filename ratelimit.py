@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+from cache import MISSING, LRUCache
+from metrics import Counter, Histogram, observe
+
+logger = logging.getLogger(__name__)
+
+throttle_seconds = Histogram("telegram_throttle_seconds", "Time outgoing messages waited for the rate limiter")
+flood_waits = Counter("telegram_flood_waits_total", "RetryAfter responses from Telegram", ("method",))
+
+# Methods that post into a chat and count against Telegram's flood limits
+SENDING_PREFIXES = ("Send", "Forward", "Copy")
+
+
+class TokenBucket:
+    """Token bucket where callers reserve tokens up front and sleep off any deficit.
+
+    Reservations may push the balance below zero; each caller then waits until
+    its share has been refilled, so concurrent senders are served in FIFO order
+    without polling.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float = 1) -> float:
+        """Take `amount` tokens and return how many seconds to wait before using them."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def block(self, seconds: float):
+        """Put the bucket into enough deficit that no reservation is served for `seconds`."""
+        self.reserve(0)
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Bot session middleware pacing outgoing messages to Telegram's limits.
+
+    Every sending method takes tokens from a global bucket and from a bucket for
+    its chat. A media group costs one global token per item but a single chat
+    token, so a cow's album still goes out without delay. If Telegram still answers
+    with RetryAfter, the chat's bucket (the global one if there is no chat) is
+    blocked for retry_after seconds, so every sender backs off, and the request is
+    retried once its turn comes. Waits longer than `max_retry_after` are not
+    sat out; the error is raised instead of holding the update's worker.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30,
+        chat_rate: float = 1,
+        group_rate: float = 20 / 60,
+        chat_burst: float = 3,
+        max_retries: int = 3,
+        max_retry_after: float = 30,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        # Idle chats fall out of the cache; a fresh bucket starts full anyway
+        self._chat_buckets = LRUCache(maxsize=10000, ttl=60)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is MISSING:
+            # Negative ids are groups and channels, which have a much lower limit
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = TokenBucket(rate, max(1.0, min(self.chat_burst, rate * 60)))
+        # Re-set on every use so the TTL only drops idle chats
+        self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _wait(self, delay: float):
+        if delay:
+            observe(throttle_seconds, delay)
+            await asyncio.sleep(delay)
+
+    async def _throttle(self, method: TelegramMethod):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(SENDING_PREFIXES):
+            return
+        weight = len(getattr(method, "media", None) or ()) or 1
+        await self._wait(max(self.global_bucket.reserve(weight), self._chat_bucket(chat_id).reserve()))
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        await self._throttle(method)
+        attempt = 0
+        while True:
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                flood_waits.inc(method=type(method).__name__)
+                if attempt > self.max_retries or e.retry_after > self.max_retry_after:
+                    raise
+                chat_id = getattr(method, "chat_id", None)
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+                bucket.block(e.retry_after)
+                logger.warning("Flood limit on %s, retrying in %s s", type(method).__name__, e.retry_after)
+                # Queue behind the block like any other sender to this chat
+                await self._wait(bucket.reserve())
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional
+
+from metrics import Gauge, Histogram, observe
+
+logger = logging.getLogger(__name__)
+
+pending_updates = Gauge("scheduler_pending_updates", "Updates queued or running")
+active_keys = Gauge("scheduler_active_keys", "Users/chats with queued or running updates")
+queue_wait_seconds = Histogram("scheduler_wait_seconds", "Time an update waited before a worker picked it up")
+
+Job = Callable[[], Awaitable[Any]]
+
+
+class KeyedScheduler:
+    """Runs jobs on a bounded pool of workers, in submission order per key.
+
+    Jobs with different keys run concurrently; jobs with the same key (one chat or
+    user) never overlap and run in the order they were submitted. submit() waits
+    once `max_pending` jobs are queued or running, which pushes back on whoever
+    is feeding updates in.
+    """
+
+    def __init__(self, workers: int = 32, max_pending: int = 1000):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._queues: Dict[Hashable, Deque[tuple]] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._pending = 0
+        self._idle: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def _start(self):
+        # Created lazily so the scheduler can be built before the event loop runs
+        self._ready = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, key: Hashable, job: Job):
+        if not self._tasks:
+            self._start()
+        await self._slots.acquire()
+        self._enqueue(key, job, holds_slot=True)
+
+    def submit_nowait(self, key: Hashable, job: Job):
+        """Queue a job in order without waiting for a free slot.
+
+        For jobs that must not hold up whoever submits them; they may push the
+        number of pending jobs past `max_pending`.
+        """
+        if not self._tasks:
+            self._start()
+        self._enqueue(key, job, holds_slot=False)
+
+    def _enqueue(self, key: Hashable, job: Job, holds_slot: bool):
+        self._pending += 1
+        self._idle.clear()
+        pending_updates.set(self._pending)
+        entry = (job, time.perf_counter(), holds_slot)
+        queue = self._queues.get(key)
+        if queue is None:
+            self._queues[key] = deque([entry])
+            self._ready.put_nowait(key)
+            active_keys.set(len(self._queues))
+        else:
+            # The key is already scheduled; its worker picks this up after the current job
+            queue.append(entry)
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            job, submitted, holds_slot = queue.popleft()
+            observe(queue_wait_seconds, time.perf_counter() - submitted)
+            try:
+                await job()
+            except Exception:
+                logger.exception("Update processing failed")
+            finally:
+                if holds_slot:
+                    self._slots.release()
+                self._pending -= 1
+                pending_updates.set(self._pending)
+                if self._pending == 0:
+                    self._idle.set()
+            if queue:
+                # Back of the line, so one busy user cannot starve the others
+                self._ready.put_nowait(key)
+            else:
+                del self._queues[key]
+                active_keys.set(len(self._queues))
+
+    async def join(self):
+        if self._idle is not None:
+            await self._idle.wait()
+
+    async def close(self, timeout: float = 10.0):
+        """Let queued jobs finish (up to `timeout` seconds), then stop the workers."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %s unfinished updates on shutdown", self._pending)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queues.clear()
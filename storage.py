@@ -0,0 +1,140 @@
+import asyncio
+import copy
+import json
+import logging
+import time
+from contextlib import suppress
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from cache import MISSING, LRUCache
+from database import get_pool
+
+logger = logging.getLogger(__name__)
+
+# (state, data, updated_at)
+Entry = Tuple[Optional[str], Dict[str, Any], float]
+
+
+def _encode(data: Mapping[str, Any]) -> str:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage kept in the bot database, so admin flows survive restarts.
+
+    Writes are coalesced: changes stay in memory and are flushed in one
+    transaction at most every `flush_interval` seconds, so a burst of
+    set_state/update_data calls for a user costs a single row write. States not
+    touched for `ttl` seconds are treated as empty and purged from disk.
+    """
+
+    def __init__(self, ttl: float = 7 * 24 * 3600, flush_interval: float = 1.0, cache_size: int = 10000):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._entries = LRUCache(maxsize=cache_size)
+        self._dirty: Dict[str, Entry] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._last_purge = 0.0
+
+    def _expired(self, updated_at: float) -> bool:
+        return updated_at < time.time() - self.ttl
+
+    async def _load(self, key: str) -> Entry:
+        entry = self._dirty.get(key) or self._entries.get(key)
+        if entry is MISSING:
+            async with get_pool().read() as db:
+                async with db.execute("SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key,)) as cursor:
+                    row = await cursor.fetchone()
+            entry = (row[0], json.loads(row[1]), row[2]) if row else (None, {}, 0.0)
+            # A write may have landed while we were reading
+            if key in self._dirty:
+                entry = self._dirty[key]
+            self._entries.set(key, entry)
+        if entry[0] is None and not entry[1]:
+            return entry
+        if self._expired(entry[2]):
+            return (None, {}, entry[2])
+        return entry
+
+    def _store(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        entry = (state, data, time.time())
+        self._entries.set(key, entry)
+        self._dirty[key] = entry
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Keeps running while writes arrive; failed flushes are retried next round
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush FSM states")
+
+    async def flush(self):
+        now = time.time()
+        purge = now - self._last_purge > min(self.ttl, 3600)
+        if not self._dirty and not purge:
+            return
+        dirty, self._dirty = self._dirty, {}
+        upserts = []
+        deletes = []
+        for key, (state, data, updated_at) in dirty.items():
+            if state is None and not data:
+                deletes.append((key,))
+            else:
+                upserts.append((key, state, _encode(data), updated_at))
+        try:
+            async with get_pool().write() as db:
+                if upserts:
+                    await db.executemany("""
+                        INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                        ON CONFLICT(key) DO UPDATE SET
+                            state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+                    """, upserts)
+                if deletes:
+                    await db.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
+                if purge:
+                    await db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (now - self.ttl,))
+        except BaseException:
+            # Put back whatever has not been overwritten since, to retry on the next flush
+            for key, entry in dirty.items():
+                self._dirty.setdefault(key, entry)
+            raise
+        if purge:
+            self._last_purge = now
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        _, data, _ = await self._load(storage_key)
+        self._store(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise ValueError(f"Data must be a dict, got {type(data).__name__}")
+        storage_key = self.key_builder.build(key)
+        state, _, _ = await self._load(storage_key)
+        self._store(storage_key, state, copy.deepcopy(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data, _ = await self._load(self.key_builder.build(key))
+        return copy.deepcopy(data)
+
+    async def close(self) -> None:
+        task, self._flush_task = self._flush_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            # Let an interrupted flush put its entries back before the final flush
+            with suppress(asyncio.CancelledError):
+                await task
+        if self._dirty:
+            await self.flush()
@@ -1,26 +1,116 @@
+import re
+from functools import lru_cache
+
+# Uzbek Latin text uses several apostrophe look-alikes for o‘, g‘ and the tutuq belgisi
+APOSTROPHES = "'ʻʼ‘’`"
+
+LATIN_TO_CYRILLIC = {
+    "a": "а", "b": "б", "d": "д", "e": "е", "f": "ф", "g": "г", "h": "ҳ",
+    "i": "и", "j": "ж", "k": "к", "l": "л", "m": "м", "n": "н", "o": "о",
+    "p": "п", "q": "қ", "r": "р", "s": "с", "t": "т", "u": "у", "v": "в",
+    "x": "х", "y": "й", "z": "з", "sh": "ш", "ch": "ч", "yo": "ё", "yu": "ю",
+    "ya": "я", "ye": "йе",
+}
+for _apostrophe in APOSTROPHES:
+    # "yo'l" is й + ў, not ё + ъ; the longer key keeps "yo" from taking the "o"
+    LATIN_TO_CYRILLIC["yo" + _apostrophe] = "йў"
+    LATIN_TO_CYRILLIC["o" + _apostrophe] = "ў"
+    LATIN_TO_CYRILLIC["g" + _apostrophe] = "ғ"
+    LATIN_TO_CYRILLIC[_apostrophe] = "ъ"
+
+# At the start of a word "e" is written "э" and "ye" is written "е"
+LATIN_WORD_START = {"e": "э", "ye": "е"}
+
+CYRILLIC_TO_LATIN = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "yo",
+    "ж": "j", "з": "z", "и": "i", "й": "y", "к": "k", "л": "l", "м": "m",
+    "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "у": "u",
+    "ф": "f", "х": "x", "ц": "ts", "ч": "ch", "ш": "sh", "ъ": "'", "ь": "",
+    "э": "e", "ю": "yu", "я": "ya", "ў": "o'", "қ": "q", "ғ": "g'", "ҳ": "h",
+}
+
+CYRILLIC_WORD_START = {"е": "ye"}
+
+
+def _compile(keys):
+    # Longest keys first so the alternation always takes the longest match
+    alternatives = sorted(keys, key=len, reverse=True)
+    return re.compile("|".join(re.escape(k) for k in alternatives), re.IGNORECASE)
+
+
+_LATIN_RE = _compile(LATIN_TO_CYRILLIC)
+_CYRILLIC_RE = _compile(CYRILLIC_TO_LATIN)
+
+
+def _at_word_start(text: str, pos: int) -> bool:
+    return pos == 0 or not text[pos - 1].isalpha()
+
+
+def _is_upper_at(text: str, pos: int) -> bool:
+    return 0 <= pos < len(text) and text[pos].isupper()
+
+
+def _latin_sub(match: re.Match) -> str:
+    source = match.group()
+    key = source.lower()
+    if key in LATIN_WORD_START and _at_word_start(match.string, match.start()):
+        target = LATIN_WORD_START[key]
+    else:
+        target = LATIN_TO_CYRILLIC[key]
+    if source[0].isupper():
+        # "SH", "Sh" and "S" all start an uppercase letter; an all-caps digraph
+        # like "YE" -> "ЙЕ" keeps the rest uppercase too
+        if source.isupper():
+            return target.upper()
+        return target[0].upper() + target[1:]
+    return target
+
+
+def _cyrillic_sub(match: re.Match) -> str:
+    text = match.string
+    source = match.group()
+    key = source.lower()
+    if key in CYRILLIC_WORD_START and _at_word_start(text, match.start()):
+        target = CYRILLIC_WORD_START[key]
+    else:
+        target = CYRILLIC_TO_LATIN[key]
+    if not source.isupper() or not target:
+        return target
+    # "Ш" becomes "SH" inside an all-caps word and "Sh" otherwise
+    if len(target) > 1 and target[1].isalpha():
+        pos = match.start()
+        if _is_upper_at(text, pos + 1) or (not text[pos + 1:pos + 2].isalpha() and _is_upper_at(text, pos - 1)):
+            return target.upper()
+    return target[0].upper() + target[1:]
+
+
+@lru_cache(maxsize=512)
 def latin_to_cyrillic(text: str) -> str:
-    mapping = {
-        "a": "а", "b": "б", "d": "д", "e": "е", "f": "ф", "g": "г", "h": "ҳ",
-        "i": "и", "j": "ж", "k": "к", "l": "л", "m": "м", "n": "н", "o": "о",
-        "p": "п", "q": "қ", "r": "р", "s": "с", "t": "т", "u": "у", "v": "в",
-        "x": "х", "y": "й", "z": "з", "o'": "ў", "g'": "ғ", "sh": "ш", "ch": "ч",
-        "ng": "нг", "A": "А", "B": "Б", "D": "Д", "E": "Е", "F": "Ф", "G": "Г",
-        "H": "Ҳ", "I": "И", "J": "Ж", "K": "К", "L": "Л", "M": "М", "N": "Н",
-        "O": "О", "P": "П", "Q": "Қ", "R": "Р", "S": "С", "T": "Т", "U": "У",
-        "V": "В", "X": "Х", "Y": "Й", "Z": "З", "O'": "Ў", "G'": "Ғ", "Sh": "Ш",
-        "Ch": "Ч", "Ng": "Нг", "'": "ъ"
-    }
-    
-    # Handle composite characters first to avoid partial replacements
-    composites = ["Sh", "sh", "Ch", "ch", "Ng", "ng", "O'", "o'", "G'", "g'"]
-    
-    result = text
-    for comp in composites:
-        if comp in mapping:
-            result = result.replace(comp, mapping[comp])
-            
-    for char, cyr in mapping.items():
-        if char not in composites:
-            result = result.replace(char, cyr)
-            
-    return result
+    """
+    >>> latin_to_cyrillic("yo'l")
+    'йўл'
+    >>> latin_to_cyrillic("YO'Q")
+    'ЙЎҚ'
+    >>> latin_to_cyrillic("Yo'ldosh yoshi")
+    'Йўлдош ёши'
+    """
+    return _LATIN_RE.sub(_latin_sub, text)
+
+
+@lru_cache(maxsize=512)
+def cyrillic_to_latin(text: str) -> str:
+    return _CYRILLIC_RE.sub(_cyrillic_sub, text)
+
+
+_NON_WORD_RE = re.compile(r"[\W_]+")
+_APOSTROPHE_RE = re.compile("[" + re.escape(APOSTROPHES) + "]")
+
+
+def normalize_for_search(text: str) -> str:
+    """Fold text in either script to lowercase Latin words for full-text search.
+
+    Apostrophes are dropped ("o'g'il" and "ўғил" both become "ogil") and any other
+    punctuation separates words.
+    """
+    text = _APOSTROPHE_RE.sub("", cyrillic_to_latin(text).lower())
+    return _NON_WORD_RE.sub(" ", text).strip()